@@ -1,46 +1,77 @@
 #!/usr/bin/python
 
-import gzip
+import os
 import logging
-from Bio.SeqIO.QualityIO import FastqGeneralIterator
-from Bio.SeqIO.FastaIO import SimpleFastaParser
+from itertools import zip_longest
 
+# Use the ISA-L implementation of gzip for faster decompression, if available
+try:
+    from isal import igzip as gzip
+except ImportError:
+    import gzip
 
-def count_fasta_reads(fp):
-    n = 0
-    if fp.endswith(".gz"):
-        with gzip.open(fp, "rt") as f:
-            for record in SimpleFastaParser(f):
-                n += 1
-    else:
-        with open(fp, "rt") as f:
-            for record in SimpleFastaParser(f):
-                n += 1
+# Use rapidgzip to decompress large files in parallel, if available
+try:
+    import rapidgzip
+except ImportError:
+    rapidgzip = None
 
-    return n
+# Number of bytes read at a time when scanning through a file
+CHUNK_SIZE = 1 << 20
 
+# Compressed files larger than this (in bytes) are decompressed in parallel
+PARALLEL_GZIP_SIZE = 500000000
 
-def count_fastq_reads(fp):
-    n = 0
-    if fp.endswith(".gz"):
-        with gzip.open(fp, "rt") as f:
-            for record in FastqGeneralIterator(f):
-                n += 1
-    else:
-        with open(fp, "rt") as f:
-            for record in FastqGeneralIterator(f):
-                n += 1
+# Number of FASTQ records written out at a time
+WRITE_BATCH_SIZE = 8192
 
-    # If no reads were found, try counting it as a FASTA
-    if n == 0:
-        logging.info("No FASTQ reads found, trying to read as FASTA")
-        n = count_fasta_reads(fp)
 
-    return n
+def open_binary(fp):
+    """Open a file for reading as bytes, decompressing it if needed."""
+    if fp.endswith(".gz"):
+        if rapidgzip is not None and os.path.getsize(fp) > PARALLEL_GZIP_SIZE:
+            logging.info("Decompressing {} in parallel".format(fp))
+            return rapidgzip.open(fp, parallelization=os.cpu_count())
+        return gzip.open(fp, "rb")
+    else:
+        return open(fp, "rb")
+
+
+def check_fastq_headers(fp):
+    """Count the reads in a FASTQ file whose headers can be used as they are.
+
+    The headers only need to be rewritten if a record is malformed, or if two
+    records in a row have the same name (up to the first whitespace), which
+    would make their alignments look like those of a single read. Returns
+    None if the headers need to be rewritten.
+    """
+    n_reads = 0
+    last_name = None
+    with open(fp, "rb", buffering=CHUNK_SIZE) as f:
+        records = zip_longest(*[f] * 4, fillvalue=b"")
+        for header, seq, spacer, qual in records:
+            # Skip blank lines at the end of the file, as clean_fastq_headers does
+            if len(header) <= 1 and len(seq) <= 1 and len(spacer) <= 1 and len(qual) <= 1:
+                continue
+            if header[:1] != b"@" or spacer[:1] != b"+":
+                return None
+            if len(seq) <= 1 or len(qual) <= 1:
+                return None
+
+            name = header.split(None, 1)[0]
+            if name == last_name:
+                return None
+            last_name = name
+            n_reads += 1
+
+    return n_reads
 
 
 def clean_fastq_headers(fp_in, fp_out):
-    """Read in a FASTQ file and write out a copy with unique headers."""
+    """Read in a FASTQ file (path or open stream) and write out a copy with unique headers.
+
+    Returns the number of reads written out.
+    """
 
     # Constraints
     # 1. Headers start with '@'
@@ -50,41 +81,78 @@ def clean_fastq_headers(fp_in, fp_out):
     # 5. Spacer lines match the header line
     # 6. Quality lines are not empty
 
-    with open(fp_in, "rt") as f_in:
-        with open(fp_out, "wt") as f_out:
-            # Keep track of the line number
-            for ix, line in enumerate(f_in):
-                # Get the line position 0-3
-                mod = ix % 4
-
-                if mod == 0:
-                    # Skip lines that are blank (at the end of the file)
-                    if len(line) == 1:
-                        continue
-                    # 1. Headers start with '@'
-                    assert line[0] == '@', "Header lacks '@' ({})".format(line)
-
-                    # 2. Strip to the first whitespace
-                    line = line.rstrip("\n").split(" ")[0].split("\t")[0]
-
-                    # 3. Add a unique line number and the newline
-                    line = "{}-r{}\n".format(line, 1 + (ix / 4))
-
-                    # Save the header to use for the spacer line
-                    header = line[1:]
-
-                elif mod == 1:
-                    # 4. Sequence lines are not empty
-                    assert len(line) > 1
-
-                elif mod == 2:
-                    # 5. Spacer lines start with '+' and match the header
-                    assert line[0] == "+"
-                    line = "+" + header
-
-                elif mod == 3:
-                    # 6. Quality lines are not empty
-                    assert len(line) > 1
-
-                # Write out the line
-                f_out.write(line)
+    # Reads may be passed in as a stream of bytes, e.g. from a download
+    if isinstance(fp_in, str):
+        f_in = open(fp_in, "rb", buffering=CHUNK_SIZE)
+    else:
+        f_in = fp_in
+
+    with f_in:
+        with open(fp_out, "wb", buffering=CHUNK_SIZE) as f_out:
+            # Records which are waiting to be written out
+            batch = []
+            n_reads = 0
+
+            # Iterate over the file four lines (one record) at a time
+            records = zip_longest(*[f_in] * 4, fillvalue=b"")
+            for rn, (header, seq, spacer, qual) in enumerate(records, start=1):
+                # Skip lines that are blank (at the end of the file)
+                if len(header) <= 1:
+                    continue
+                # 1. Headers start with '@'
+                assert header[:1] == b"@", "Header lacks '@' ({})".format(header)
+
+                # 2. Strip to the first whitespace
+                # 3. Add a unique record number and the newline
+                header = b"%s-r%d\n" % (header.split(None, 1)[0], rn)
+
+                # 4. Sequence lines are not empty
+                assert len(seq) > 1
+
+                # 5. Spacer lines start with '+' and match the header
+                assert spacer[:1] == b"+"
+
+                # 6. Quality lines are not empty
+                assert len(qual) > 1
+
+                batch.append(header + seq + b"+" + header[1:] + qual)
+
+                # Write out the records in batches
+                if len(batch) == WRITE_BATCH_SIZE:
+                    f_out.writelines(batch)
+                    n_reads += len(batch)
+                    batch.clear()
+
+            f_out.writelines(batch)
+            n_reads += len(batch)
+
+    return n_reads
+
+
+def concat_fastq(fps, fp_out, sep=b"|"):
+    """Combine a set of FASTQ files, adding the index of each file to the start of its headers."""
+    with open(fp_out, "wb", buffering=CHUNK_SIZE) as f_out:
+        for ix, fp in enumerate(fps):
+            header_prefix = b"@%d%s" % (ix, sep)
+            spacer_prefix = b"+%d%s" % (ix, sep)
+
+            with open(fp, "rb", buffering=CHUNK_SIZE) as f_in:
+                # Records which are waiting to be written out
+                batch = []
+
+                # Iterate over the file four lines (one record) at a time
+                qual = b"\n"
+                for header, seq, spacer, qual in zip(*[f_in] * 4):
+                    batch.append(
+                        header_prefix + header[1:] + seq +
+                        spacer_prefix + spacer[1:] + qual)
+
+                    # Write out the records in batches
+                    if len(batch) == WRITE_BATCH_SIZE:
+                        f_out.writelines(batch)
+                        batch.clear()
+
+                # End the last record with a newline, before the next file
+                if not qual.endswith(b"\n"):
+                    batch.append(b"\n")
+                f_out.writelines(batch)
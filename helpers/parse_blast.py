@@ -1,9 +1,277 @@
 #!/usr/bin/python
 """Logic needed to parse a set of BLAST results."""
 
+import os
 import json
+import mmap
 import argparse
-from collections import defaultdict
+import numpy as np
+from queue import Queue
+from threading import Thread
+from concurrent.futures import ProcessPoolExecutor
+from operator import itemgetter
+from itertools import groupby
+
+# Use orjson to write out the results, if available
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Flags marking the positions covered by any alignment, or by a unique one
+TOTAL_FLAG = 1
+UNIQUE_FLAG = 2
+
+# Number of alignments which are added to the totals at a time
+BATCH_SIZE = 100000
+
+# Largest number of positions which are marked as covered at one time
+MARK_BLOCK_SIZE = 1 << 22
+
+# Number of alignments processed between progress messages
+LOG_INTERVAL = 100000
+
+# Size of the blocks read from the alignment file by the reading thread
+READ_CHUNK_SIZE = 4 << 20
+
+# Number of blocks which may be read ahead of the parser
+READ_QUEUE_SIZE = 4
+
+
+def open_mapped(fp):
+    """Map a file into memory for reading, leaving the OS to read ahead."""
+    with open(fp, "rb") as f:
+        # Empty files cannot be mapped, and are read as normal
+        if os.fstat(f.fileno()).st_size == 0:
+            return open(fp, "rb")
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    if hasattr(mm, "madvise"):
+        mm.madvise(mmap.MADV_SEQUENTIAL)
+    return mm
+
+
+def read_chunks(f, chunks, size=None):
+    """Read a file in blocks which end on a newline, adding them to a queue.
+
+    The file (or memory map) is read as bytes, and at most `size` bytes are read.
+    """
+    try:
+        tail = b""
+        while size is None or size > 0:
+            if size is None:
+                chunk = f.read(READ_CHUNK_SIZE)
+            else:
+                chunk = f.read(min(READ_CHUNK_SIZE, size))
+                size -= len(chunk)
+            if not chunk:
+                break
+            # Hold back any partial line at the end of the block
+            chunk = tail + chunk
+            end = chunk.rfind(b"\n") + 1
+            tail = chunk[end:]
+            if end > 0:
+                chunks.put(chunk[:end])
+        # Add the newline to the final line, if it was missing
+        if tail:
+            chunks.put(tail + b"\n")
+    except Exception as e:
+        # Pass the error along to be raised by the parser
+        chunks.put(e)
+    chunks.put(None)
+
+
+def iter_lines(f, size=None):
+    """Yield the lines of a file, which is read in a separate thread."""
+    chunks = Queue(maxsize=READ_QUEUE_SIZE)
+    reader = Thread(target=read_chunks, args=(f, chunks, size), daemon=True)
+    reader.start()
+
+    while True:
+        chunk = chunks.get()
+        if chunk is None:
+            break
+        if isinstance(chunk, Exception):
+            raise chunk
+        # Every block ends with a newline, leaving an empty string at the end
+        lines = chunk.split(b"\n")
+        del lines[-1]
+        yield from lines
+
+    reader.join()
+
+
+def parse_blast_line(line, sep, max_fields,
+                     qid_ix, sid_ix, slen_ix, sstart_ix, send_ix, qseq_ix=None):
+    """Parse one line (as bytes), returning None if the read is not aligned.
+
+    The aligned query sequence is only added to the end of the result
+    when `qseq_ix` is given.
+    """
+    # Only split off as many fields as are needed. The newline is only
+    # stripped if it ends up on a field that is used, since int() ignores it
+    fields = line.split(sep, max_fields)
+    if len(fields) == max_fields:
+        fields[-1] = fields[-1].rstrip(b'\n')
+
+    # Subject ID
+    sid = fields[sid_ix]
+    if sid == b'*':
+        # Read is not aligned
+        return None
+
+    # Query ID
+    qid = fields[qid_ix]
+
+    # Alignment positions
+    sstart = int(fields[sstart_ix])  # Position of alignment start on subject
+    send = int(fields[send_ix])  # Position of alignment end on subject
+
+    # Total subject (reference) length
+    slen = int(fields[slen_ix])
+
+    if qseq_ix is not None:
+        return qid, sid, sstart, send, slen, fields[qseq_ix]
+    return qid, sid, sstart, send, slen
+
+
+def unique_by_count(query_ix, alignments):
+    """Flag the alignments for each query which only aligned once."""
+    return (np.bincount(query_ix) == 1)[query_ix]
+
+
+def unique_by_qseq(query_ix, alignments):
+    """Flag the alignments for each query where every alignment has the same query sequence."""
+    qseqs = np.array([a[5] for a in alignments])
+
+    # Find where the query sequence changes within the alignments for a query
+    changed = np.zeros(len(qseqs), dtype=bool)
+    changed[1:] = (qseqs[1:] != qseqs[:-1]) & (query_ix[1:] == query_ix[:-1])
+
+    return (np.bincount(query_ix, weights=changed) == 0)[query_ix]
+
+
+# Ways of deciding whether the alignments for a query are unique
+UNIQUE_BY = {
+    "count": unique_by_count,
+    "qseq": unique_by_qseq,
+}
+
+
+def mark_regions(coverage, starts, ends, flag):
+    """Set a flag on every position within a set of regions of an array."""
+    lengths = ends - starts
+    if len(lengths) == 0:
+        return
+
+    # Split the regions into blocks, limiting the number of
+    # positions which are held in memory at one time
+    total = np.cumsum(lengths)
+    splits = np.searchsorted(
+        total, np.arange(MARK_BLOCK_SIZE, total[-1], MARK_BLOCK_SIZE))
+
+    for block_starts, block_lengths in zip(
+        np.split(starts, splits), np.split(lengths, splits)
+    ):
+        # Each position is the start of its region, plus its distance from
+        # that start, which is counted along all of the regions at once
+        block_offsets = np.cumsum(block_lengths) - block_lengths
+        positions = np.arange(block_lengths.sum()) + np.repeat(
+            block_starts - block_offsets, block_lengths)
+        coverage[positions] |= flag
+
+
+def split_by_query(blast_fp, n_parts, qid_ix=0, sep='\t'):
+    """Find the byte ranges which split a file into roughly equal parts.
+
+    Each part starts on a new query, so that all of the alignments for
+    a single query always fall within the same part.
+    """
+    size = os.path.getsize(blast_fp)
+    sep = sep.encode()
+    offsets = [0]
+
+    with open(blast_fp, "rb") as f:
+        for i in range(1, n_parts):
+            # Skip ahead to the first full line after the evenly-spaced offset
+            target = size * i // n_parts
+            if target <= offsets[-1]:
+                continue
+            f.seek(target - 1)
+            f.readline()
+
+            # Move forward until the query ID changes
+            pos = f.tell()
+            qid = f.readline().split(sep, qid_ix + 1)[qid_ix]
+            while True:
+                pos = f.tell()
+                line = f.readline()
+                if not line or line.split(sep, qid_ix + 1)[qid_ix] != qid:
+                    break
+
+            if offsets[-1] < pos < size:
+                offsets.append(pos)
+
+    offsets.append(size)
+    return list(zip(offsets[:-1], offsets[1:]))
+
+
+def parse_part(blast_fp, start, end, options):
+    """Parse one byte range of a file, in a worker process."""
+    parser = BlastParser(blast_fp, **options)
+    parser.parse_range(start, end)
+
+    # Drop the unused space at the end of the coverage array,
+    # before it is sent back to the main process
+    parser.coverage = parser.coverage[:parser.coverage_size]
+    return parser
+
+
+def parse_samples(blast_fp, n_samples, sample_sep=b"|", **kwargs):
+    """Parse the alignments for a set of samples which were aligned together.
+
+    Each query ID starts with the index of its sample and `sample_sep`,
+    and the alignments are split up to return one parser per sample.
+    """
+    parsers = [BlastParser(blast_fp, **kwargs) for ix in range(n_samples)]
+
+    # Alignments for each sample which have yet to be added to the totals
+    batches = [[] for ix in range(n_samples)]
+
+    for alignments in parsers[0].yield_alignments():
+        # Add the alignments for each query to the batch for its sample
+        ix = int(alignments[0][0].split(sample_sep, 1)[0])
+        batch = batches[ix]
+        batch.extend(alignments)
+
+        if len(batch) >= BATCH_SIZE:
+            parsers[ix].add_batch(batch)
+            batches[ix] = []
+
+    for parser, batch in zip(parsers, batches):
+        parser.add_batch(batch)
+
+    return parsers
+
+
+class Reference:
+    """Alignments to a single reference, kept together for quick lookup."""
+
+    __slots__ = ("length", "total_reads", "unique_reads", "total_bases",
+                 "unique_bases", "offset")
+
+    def __init__(self, slen, offset):
+        # The total length of the reference (stored as a float)
+        self.length = float(slen)
+
+        # Number of reads and bases aligned to the reference
+        self.total_reads = 0
+        self.unique_reads = 0
+        self.total_bases = 0
+        self.unique_bases = 0
+
+        # The position where the reference starts in the coverage array
+        self.offset = offset
 
 
 class BlastParser:
@@ -11,8 +279,20 @@ class BlastParser:
 
     def __init__(self, blast_fp,
                  qid_ix=0, sid_ix=1, slen_ix=2, sstart_ix=3, send_ix=4,
-                 comment_char='@', sep='\t', logging=False):
-        """Parse a set of BLAST results."""
+                 comment_char='@', sep='\t', logging=False,
+                 qseq_ix=5, unique_by="count"):
+        """Parse a set of BLAST results.
+
+        The results may be a path, or a stream of bytes which is open for
+        reading (such as the output of DIAMOND).
+
+        By default, a read is unique if it only aligned to one reference. With
+        `unique_by="qseq"`, a read is unique if every alignment has the same
+        aligned query sequence (read from the column at `qseq_ix`).
+        """
+        msg = "unique_by '{}' not recognized".format(unique_by)
+        assert unique_by in UNIQUE_BY, msg
+
         # Store the input variables
         self.blast_fp = blast_fp
         self.qid_ix = qid_ix
@@ -23,173 +303,328 @@ class BlastParser:
         self.comment_char = comment_char
         self.sep = sep
         self.logging = logging
+        self.unique_by = unique_by
 
-        # Number of reads and bases aligned to each reference
-        self.total_reads = defaultdict(int)
-        self.unique_reads = defaultdict(int)
-        self.total_bases = defaultdict(int)
-        self.unique_bases = defaultdict(int)
+        # The aligned query sequence is only parsed if it is needed
+        self.qseq_ix = qseq_ix if unique_by == "qseq" else None
 
-        # The unique set of positions that are aligned by each reference
-        self.total_pos = defaultdict(set)
-        self.unique_pos = defaultdict(set)
+        # The alignment totals for each reference, keyed by ID
+        self.refs = {}
+
+        # The positions covered by an alignment, with one byte of flags per
+        # position, for all of the references laid end to end
+        self.coverage = np.zeros(0, dtype=np.uint8)
+        self.coverage_size = 0
 
         # Keep track of the total number of reads +/- alignment
         self.total_aligned_reads = 0
 
-        # The total length of each reference
-        self.ref_len = {}
-
         # Set the highest number of fields that we might have to parse
-        self.max_fields = max(sid_ix, slen_ix, sstart_ix, send_ix) + 1
+        self.max_fields = max(
+            ix for ix in (qid_ix, sid_ix, slen_ix, sstart_ix, send_ix,
+                          self.qseq_ix)
+            if ix is not None) + 1
 
-    def yield_alignments(self):
+    def yield_alignments(self, start=0, end=None):
         """Iterate over an alignment file, and yield chunks for each query."""
+        # Streams are read from their current position to the end
+        if not isinstance(self.blast_fp, str):
+            yield from self.group_alignments(self.blast_fp)
+            return
+
+        with open_mapped(self.blast_fp) as f:
+            # Only read the requested range of bytes
+            f.seek(start)
+            size = None if end is None else end - start
+            yield from self.group_alignments(f, size)
+
+    def group_alignments(self, f, size=None):
+        """Group together the consecutive alignments for each query."""
+        alignments = self.parse_lines(iter_lines(f, size))
+        for qid, query_alignments in groupby(alignments, key=itemgetter(0)):
+            yield list(query_alignments)
+
+    def parse_lines(self, lines):
+        """Yield the parsed alignment from each line."""
+
+        # Look up attributes once, rather than for every line,
+        # converting the separators for use on lines of bytes
+        comment_char = ord(self.comment_char)
+        sep = self.sep.encode()
+        max_fields = self.max_fields
+        qid_ix = self.qid_ix
+        sid_ix = self.sid_ix
+        slen_ix = self.slen_ix
+        sstart_ix = self.sstart_ix
+        send_ix = self.send_ix
+        qseq_ix = self.qseq_ix
+        log = self.logging.info if self.logging else None
 
         # Counter for the number of lines processed
         ix = 0
-
-        # The previous query ID
-        last_qid = None
-
-        # Keep a list of all of the alignments for a single query
-        query_alignments = []
+        next_log = LOG_INTERVAL
 
         # Iterate over the file, line by line
-        with open(self.blast_fp, "rt") as f:
-            for line in f:
-                # Logging
-                if ix % 100000 == 0 and ix > 0 and self.logging:
-                    self.logging.info("Processed {:,} alignments".format(ix))
-
-                # Skip lines starting with '@', by default
-                if line[0] == self.comment_char:
-                    continue
-
-                # Parse the line
-                qid, sid, sstart, send, slen = self.parse_line(line)
-
-                # If this is a new query, yield the batch of alignments
-                if qid != last_qid:
-                    # This skips the first line
-                    if last_qid is not None:
-                        yield query_alignments
-                        # Clear the cache of alignments
-                        query_alignments = []
-                    last_qid = qid
-
-                # Append the alignment information for this line
-                query_alignments.append((qid, sid, sstart, send, slen))
-
-                # Increment the line counter
-                ix += 1
+        for line in lines:
+            # Skip lines starting with '@', by default
+            if line[0] == comment_char:
+                continue
+
+            # Parse the line, skipping reads which are not aligned
+            alignment = parse_blast_line(
+                line, sep, max_fields, qid_ix, sid_ix, slen_ix, sstart_ix,
+                send_ix, qseq_ix)
+            if alignment is None:
+                continue
+
+            yield alignment
+
+            # Increment the line counter
+            ix += 1
+
+            # Logging
+            if ix >= next_log:
+                if log:
+                    log("Processed {:,} alignments".format(ix))
+                next_log += LOG_INTERVAL
+
+        if log:
+            log("Processed {:,} alignments".format(ix))
+
+    def parse(self, processes=1):
+        """Parse the file, optionally splitting it across multiple processes."""
+        # Only files can be split up, rather than streams
+        if processes > 1 and isinstance(self.blast_fp, str):
+            self.parse_parallel(processes)
+        else:
+            self.parse_range()
 
-        yield query_alignments
+        # Check if 0 reads were aligned
+        if self.total_aligned_reads == 0 and self.logging:
+            self.logging.info("Warning, no reads were aligned")
 
-        msg = "Processed {:,} alignments".format(ix)
+    def parse_parallel(self, processes):
+        """Parse parts of the file in separate processes, and merge the totals."""
+        parts = split_by_query(self.blast_fp, processes,
+                               qid_ix=self.qid_ix, sep=self.sep)
         if self.logging:
-            self.logging.info(msg)
-
-    def parse(self):
-        """Parse the file."""
+            self.logging.info("Parsing {} in {:,} parts".format(
+                self.blast_fp, len(parts)))
+
+        # The options used to set up the parser in each process
+        options = {
+            "qid_ix": self.qid_ix,
+            "sid_ix": self.sid_ix,
+            "slen_ix": self.slen_ix,
+            "sstart_ix": self.sstart_ix,
+            "send_ix": self.send_ix,
+            "comment_char": self.comment_char,
+            "sep": self.sep,
+            "qseq_ix": self.qseq_ix,
+            "unique_by": self.unique_by,
+        }
+
+        with ProcessPoolExecutor(max_workers=processes) as pool:
+            futures = [
+                pool.submit(parse_part, self.blast_fp, start, end, options)
+                for start, end in parts
+            ]
+            for future in futures:
+                self.merge(future.result())
+
+    def merge(self, other):
+        """Add in the totals from another parser."""
+        self.total_aligned_reads += other.total_aligned_reads
+
+        for sid, other_ref in other.refs.items():
+            ref = self.refs.get(sid)
+            if ref is None:
+                ref = self.add_reference(sid, int(other_ref.length))
+
+            ref.total_reads += other_ref.total_reads
+            ref.total_bases += other_ref.total_bases
+            ref.unique_reads += other_ref.unique_reads
+            ref.unique_bases += other_ref.unique_bases
+            self.ref_coverage(ref)[:] |= other.ref_coverage(other_ref)
+
+    def add_reference(self, sid, slen):
+        """Add a new reference, making space for it in the coverage array."""
+        ref = self.refs[sid] = Reference(slen, self.coverage_size)
+        self.coverage_size += slen
+
+        # When the coverage array is full, at least double its size
+        if self.coverage_size > len(self.coverage):
+            coverage = np.zeros(
+                max(self.coverage_size, 2 * len(self.coverage)), dtype=np.uint8)
+            coverage[:len(self.coverage)] = self.coverage
+            self.coverage = coverage
+
+        return ref
+
+    def ref_coverage(self, ref):
+        """Return the coverage array for a single reference."""
+        return self.coverage[ref.offset:ref.offset + int(ref.length)]
+
+    def parse_range(self, start=0, end=None):
+        """Parse a range of bytes from the file (by default, all of it)."""
+
+        # Alignments which have yet to be added to the totals
+        batch = []
 
         # Yield groups of alignments, all for a single query sequence
-        for alignments in self.yield_alignments():
-
-            # Keep track of how many reads were aligned
-            self.total_aligned_reads += 1
-
-            # If there is only one alignment, then it was unique
-            is_unique = len(alignments) == 1
-
-            # Process each of the alignments
-            for qid, sid, sstart, send, slen in alignments:
-                # Calculate the alignment length
-                alen = send - sstart
-
-                # Subject region covered by the alignment
-                pos_range = set(range(sstart, send))
-
-                # Add the length of the subject, if needed
-                if sid not in self.ref_len:
-                    self.ref_len[sid] = float(slen)
-
-                # Add the unique alignment information
-                if is_unique:
-                    self.unique_bases[sid] += alen
-                    self.unique_reads[sid] += 1
-                    # Add the alignment positions
-                    self.unique_pos[sid] |= pos_range
-
-                # No matter what, add to the totals
-                self.total_bases[sid] += alen
-                self.total_reads[sid] += 1
-                self.total_pos[sid] |= pos_range
-
-        # Check if 0 reads were aligned
-        if self.total_aligned_reads == 0:
-            self.logging.info("Warning, no reads were aligned")
+        for alignments in self.yield_alignments(start, end):
+            batch.extend(alignments)
+
+            # Add the alignments to the totals in batches, which always
+            # contain every alignment for each query
+            if len(batch) >= BATCH_SIZE:
+                self.add_batch(batch)
+                batch = []
+
+        self.add_batch(batch)
+
+    def add_batch(self, alignments):
+        """Add a batch of alignments (sorted by query) to the totals."""
+        if len(alignments) == 0:
+            return
+
+        # Split the alignments into columns
+        qids, sids, sstarts, sends, slens = list(zip(*alignments))[:5]
+
+        # Index the query for each alignment, starting a new query
+        # wherever the query ID changes
+        qids = np.array(qids)
+        new_query = np.ones(len(qids), dtype=bool)
+        new_query[1:] = qids[1:] != qids[:-1]
+        query_ix = np.cumsum(new_query) - 1
+
+        # Keep track of how many reads were aligned
+        self.total_aligned_reads += int(query_ix[-1]) + 1
+
+        # Flag the alignments for the queries which were unique
+        is_unique = UNIQUE_BY[self.unique_by](query_ix, alignments)
+
+        # Orient the alignment positions so that sstart < send,
+        # converting the start position to 0-index
+        sstarts = np.array(sstarts)
+        sends = np.array(sends)
+        sstart = np.minimum(sstarts, sends) - 1
+        send = np.maximum(sstarts, sends)
+
+        # Calculate the alignment length
+        alen = send - sstart
+
+        # Index the reference for each alignment
+        ref_ids, first_ix, ref_ix = np.unique(
+            np.array(sids), return_index=True, return_inverse=True)
+        n_refs = len(ref_ids)
+
+        # Sum up the reads and bases aligned to each reference
+        total_reads = np.bincount(ref_ix, minlength=n_refs)
+        total_bases = np.bincount(ref_ix, weights=alen, minlength=n_refs)
+        unique_reads = np.bincount(ref_ix[is_unique], minlength=n_refs)
+        unique_bases = np.bincount(
+            ref_ix[is_unique], weights=alen[is_unique], minlength=n_refs)
+
+        # Look up each reference once for the whole batch, keeping the
+        # start of its coverage to be indexed by position in the batch
+        batch_offsets = []
+        for sid, slen, tr, tb, ur, ub in zip(
+            [sid.decode() for sid in ref_ids.tolist()],
+            np.array(slens)[first_ix].tolist(),
+            total_reads.tolist(),
+            total_bases.astype(np.int64).tolist(),
+            unique_reads.tolist(),
+            unique_bases.astype(np.int64).tolist()
+        ):
+            # Add the subject, if needed
+            ref = self.refs.get(sid)
+            if ref is None:
+                ref = self.add_reference(sid, slen)
+
+            ref.total_reads += tr
+            ref.total_bases += tb
+            ref.unique_reads += ur
+            ref.unique_bases += ub
+            batch_offsets.append(ref.offset)
+
+        # Find the region of the coverage array covered by each alignment
+        offsets = np.array(batch_offsets, dtype=np.int64)[ref_ix]
+        starts = offsets + sstart
+        ends = offsets + send
+
+        # Skip any alignment which repeats the region marked by the one before it
+        is_new = np.ones(len(starts), dtype=bool)
+        is_new[1:] = (
+            (starts[1:] != starts[:-1]) | (ends[1:] != ends[:-1]) |
+            (is_unique[1:] != is_unique[:-1])
+        )
+
+        # Mark every position covered by an alignment, and then every
+        # position covered by a unique alignment, for the whole batch at once
+        mark_regions(self.coverage, starts[is_new], ends[is_new], TOTAL_FLAG)
+        is_new &= is_unique
+        mark_regions(self.coverage, starts[is_new], ends[is_new], UNIQUE_FLAG)
 
     def parse_line(self, line):
-        """Parse one line."""
-        line = line.strip('\n').split('\t', self.max_fields)
-
-        # Subject ID
-        sid = line[self.sid_ix]
-        if sid == '*':
-            # Read is not aligned
-            return None, None, None, None, None, None
-
-        # Query ID
-        qid = line[self.qid_ix]
-
-        # Alignment positions
-        sstart = int(line[self.sstart_ix])  # Position of alignment start on subject
-        send = int(line[self.send_ix])  # Position of alignment end on subject
-        # Orient the alignment positions so that sstart < send
-        if send < sstart:
-            send, sstart = sstart, send
-
-        # Convert to 0-index
-        sstart = sstart - 1
-
-        # Total subject (reference) length
-        slen = int(line[self.slen_ix])
-
-        return qid, sid, sstart, send, slen
+        """Parse one line (as bytes)."""
+        return parse_blast_line(
+            line, self.sep.encode(), self.max_fields, self.qid_ix, self.sid_ix,
+            self.slen_ix, self.sstart_ix, self.send_ix, self.qseq_ix)
 
     def make_summary(self):
         """Make the final output."""
+        return self.total_aligned_reads, list(self.iter_summary())
+
+    def iter_summary(self):
+        """Yield the summary statistics for each reference, one at a time."""
+
+        # Stack the totals for every reference into arrays
+        refs = list(self.refs.values())
+        rl = np.array([ref.length for ref in refs], dtype=np.float64)
+        total_reads = np.array([ref.total_reads for ref in refs], dtype=np.int64)
+        unique_reads = np.array([ref.unique_reads for ref in refs], dtype=np.int64)
+        total_bases = np.array([ref.total_bases for ref in refs], dtype=np.float64)
+        unique_bases = np.array([ref.unique_bases for ref in refs], dtype=np.float64)
+
+        # Count the positions covered in each reference, summing over the
+        # whole coverage array at once
+        if len(refs) > 0:
+            offsets = np.array([ref.offset for ref in refs], dtype=np.int64)
+            coverage = self.coverage[:self.coverage_size]
+            total_pos = np.add.reduceat(
+                coverage != 0, offsets, dtype=np.float64)
+            unique_pos = np.add.reduceat(
+                (coverage & UNIQUE_FLAG) != 0, offsets, dtype=np.float64)
+        else:
+            total_pos = unique_pos = np.zeros(0, dtype=np.float64)
 
-        # Make the output object as a list
-        out = []
-
-        for k, v in self.total_bases.items():
-            # Information for a single item
-            d = {'id': k}
-            # Reference length (stored as a float)
-            rl = self.ref_len[k]
-            d['length'] = int(rl)
+        # Calculate each field for all of the references at once
+        columns = [
+            ('id', list(self.refs)),
+            # Reference length
+            ('length', rl.astype(np.int64)),
             # Depth = total aligned bases / reference length
-            d['total_depth'] = round(v / rl, 4)
-            d['unique_depth'] = round(self.unique_bases.get(k, 0) / rl, 4)
+            ('total_depth', np.round(total_bases / rl, 4)),
+            ('unique_depth', np.round(unique_bases / rl, 4)),
             # Coverage = number of positions covered / reference length
-            d['total_coverage'] = round(len(self.total_pos[k]) / rl, 4)
-            d['unique_coverage'] = round(len(self.unique_pos[k]) / rl, 4)
+            ('total_coverage', np.round(total_pos / rl, 4)),
+            ('unique_coverage', np.round(unique_pos / rl, 4)),
             # RPKM = aligned reads / kb of reference / million aligned reads
-            d['total_rpkm'] = round(
-                self.rpkm(self.total_reads[k], rl, self.total_aligned_reads),
-                6)
-            d['unique_rpkm'] = round(
-                self.rpkm(self.unique_reads[k], rl, self.total_aligned_reads),
-                6)
+            ('total_rpkm', np.round(
+                self.rpkm(total_reads, rl, self.total_aligned_reads), 6)),
+            ('unique_rpkm', np.round(
+                self.rpkm(unique_reads, rl, self.total_aligned_reads), 6)),
             # Number of reads
-            d["total_reads"] = self.total_reads[k]
-            d["unique_reads"] = self.unique_reads[k]
-
-            out.append(d)
+            ('total_reads', total_reads),
+            ('unique_reads', unique_reads),
+        ]
 
-        return self.total_aligned_reads, out
+        # Yield one dict per reference
+        keys = [k for k, v in columns]
+        values = [v if isinstance(v, list) else v.tolist() for k, v in columns]
+        for row in zip(*values):
+            yield dict(zip(keys, row))
 
     def rpkm(self, reads, ref_len, total_reads, amino_acid_ref=True):
         """Calculate RPKM (reads per kilobase per million reads)."""
@@ -210,7 +645,8 @@ if __name__ == "__main__":
                         help="""Location of BLAST results file.""")
     parser.add_argument("--out",
                         type=str,
-                        help="""Path to write results out to.""")
+                        help="""Path to write results out to, as lines of JSON: the first
+                        line is {"total_aligned_reads": N}, followed by one line per reference.""")
     parser.add_argument("--qseqid", default=0, type=int,
                         help=("Index position (0-based) for column with query ID"))
     parser.add_argument("--sseqid", default=1, type=int,
@@ -223,13 +659,32 @@ if __name__ == "__main__":
                         help=("Index position (0-based) for column with subject end position"))
     parser.add_argument("--qseq", default=5, type=int,
                         help=("Index position (0-based) for column with aligned query sequence"))
+    parser.add_argument("--unique-by", default="count", choices=["count", "qseq"],
+                        help=("Count a read as unique if it has a single alignment (count), "
+                              "or if every alignment has the same query sequence (qseq)"))
+    parser.add_argument("--processes", default=1, type=int,
+                        help=("Number of processes used to parse the file"))
 
     args = parser.parse_args()
 
-    blast_parser = BlastParser(args.input, args.qseqid, args.sseqid,
-                               args.slen, args.sstart, args.send,
-                               args.qseq)
-    blast_parser.parse()
-    results = blast_parser.make_summary()
-    with open(args.out, 'wt') as fo:
-        json.dump(results, fo)
+    blast_parser = BlastParser(args.input, qid_ix=args.qseqid,
+                               sid_ix=args.sseqid, slen_ix=args.slen,
+                               sstart_ix=args.sstart, send_ix=args.send,
+                               qseq_ix=args.qseq, unique_by=args.unique_by)
+    blast_parser.parse(processes=args.processes)
+
+    # Write out the number of aligned reads, and then the summary for each
+    # reference, as lines of JSON
+    header = {"total_aligned_reads": blast_parser.total_aligned_reads}
+    with open(args.out, 'wb', buffering=1 << 20) as fo:
+        if orjson is not None:
+            fo.write(orjson.dumps(header, option=orjson.OPT_APPEND_NEWLINE))
+            fo.writelines(
+                orjson.dumps(d, option=orjson.OPT_APPEND_NEWLINE)
+                for d in blast_parser.iter_summary())
+        else:
+            fo.write(json.dumps(header).encode())
+            fo.write(b"\n")
+            for d in blast_parser.iter_summary():
+                fo.write(json.dumps(d).encode())
+                fo.write(b"\n")
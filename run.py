@@ -3,43 +3,148 @@
 
 import os
 import sys
+import glob
 import time
 import json
+import gzip
 import uuid
+import heapq
 import boto3
+import fcntl
+import hashlib
 import shutil
 import logging
 import argparse
+import contextvars
 import traceback
+import collections
+import tempfile
+import threading
 import subprocess
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import ProcessPoolExecutor
+from boto3.s3.transfer import TransferConfig
+from botocore.exceptions import ClientError
 from helpers.parse_blast import BlastParser
-from helpers.fastq_utils import count_fastq_reads
+from helpers.parse_blast import parse_samples
+from helpers.fastq_utils import open_binary
+from helpers.fastq_utils import check_fastq_headers
 from helpers.fastq_utils import clean_fastq_headers
+from helpers.fastq_utils import concat_fastq
+
+# Use orjson to write out the results, if available
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Use zstandard to compress the results, if requested
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Use python-isal to gzip the results across several threads, if available
+try:
+    from isal import igzip_threaded
+except ImportError:
+    igzip_threaded = None
+
+# File extension for the results, for each type of compression
+OUTPUT_EXTENSIONS = {
+    "gzip": ".json.gz",
+    "zstd": ".json.zst",
+}
+
+# Log messages kept in memory, to be added to the output for each sample,
+# as (time, line) for each sample (None for messages not about one sample)
+LOG_RECORDS = collections.defaultdict(list)
+
+# Sample which the log messages are about, in the current thread
+LOG_SAMPLE = contextvars.ContextVar("LOG_SAMPLE", default=None)
+
+# Only the end of a longer log is added to the output (in characters)
+MAX_LOG_SIZE = 1 << 20
+
+# Folder on ENA containing the FASTQ files for each SRA accession
+ENA_FASTQ_URL = "ftp://ftp.sra.ebi.ac.uk/vol1/fastq"
+
+# Endings of the FASTQ files which ENA may have for an accession
+ENA_FILE_ENDINGS = ["_1.fastq.gz", "_2.fastq.gz", ".fastq.gz"]
+
+# Client used to access S3, set up when it is first needed (the lock stops
+# two threads from setting it up at once, which boto3 doesn't allow)
+S3_CLIENT = None
+S3_CLIENT_LOCK = threading.Lock()
+
+# Files on S3 are transferred in parts of this size (in bytes)
+S3_PART_SIZE = 8 * 1024 * 1024
+
+# Reference databases can be 100s of Gb, and are downloaded in larger parts
+S3_DB_PART_SIZE = 64 * 1024 * 1024
+
+
+def get_s3_client():
+    """Return the S3 client, reusing it after it has been set up once."""
+    global S3_CLIENT
+    with S3_CLIENT_LOCK:
+        if S3_CLIENT is None:
+            S3_CLIENT = boto3.client('s3')
+    return S3_CLIENT
+
+
+def reset_s3_client():
+    """Set up a new S3 client when it is next needed, e.g. in a forked process."""
+    global S3_CLIENT, S3_CLIENT_LOCK
+    S3_CLIENT = None
+    S3_CLIENT_LOCK = threading.Lock()
+
+
+def split_s3_url(url):
+    """Split an S3 URL into the bucket and key."""
+    bucket, _, key = url[5:].partition('/')
+    return bucket, key
+
+
+def s3_transfer_config(threads=16, part_size=S3_PART_SIZE):
+    """Set up S3 transfers to move the parts of large files in parallel."""
+    return TransferConfig(multipart_threshold=part_size,
+                          multipart_chunksize=part_size,
+                          max_concurrency=threads)
 
 
 def run_cmds(commands, retry=0, catchExcept=False):
     """Run commands and write out the log, combining STDOUT & STDERR."""
-    logging.info("Commands:")
-    logging.info(' '.join(commands))
+    # Only format the messages if they will be logged
+    log_info = logging.getLogger().isEnabledFor(logging.INFO)
+    if log_info:
+        logging.info("Commands:")
+        logging.info(' '.join(commands))
+    # Giving the full path of the program, and leaving open file descriptors
+    # alone (Python opens them as non-inheritable), lets Python start the
+    # process with posix_spawn, without copying the page tables of this process
     p = subprocess.Popen(commands,
+                         executable=shutil.which(commands[0]) or commands[0],
+                         close_fds=False,
                          stdout=subprocess.PIPE,
                          stderr=subprocess.STDOUT)
-    stdout, stderr = p.communicate()
+    # Log the output as it is written, rather than holding all of it
+    # in memory until the command finishes
+    for ix, line in enumerate(p.stdout):
+        if not log_info:
+            continue
+        if ix == 0:
+            logging.info("Standard output of subprocess:")
+        logging.info(line.decode("utf-8", "replace").rstrip("\n"))
+    p.stdout.close()
     exitcode = p.wait()
-    if stdout:
-        logging.info("Standard output of subprocess:")
-        for line in stdout.split('\n'):
-            logging.info(line)
-    if stderr:
-        logging.info("Standard error of subprocess:")
-        for line in stderr.split('\n'):
-            logging.info(line)
 
     # Check the exit code
     if exitcode != 0 and retry > 0:
         msg = "Exit code {}, retrying {} more times".format(exitcode, retry)
         logging.info(msg)
-        run_cmds(commands, retry=retry - 1)
+        run_cmds(commands, retry=retry - 1, catchExcept=catchExcept)
     elif exitcode != 0 and catchExcept:
         msg = "Exit code was {}, but we will continue anyway"
         logging.info(msg.format(exitcode))
@@ -53,13 +158,25 @@ def calc_abund(input_str,
                output_folder,
                evalue=0.00001,
                blocks=1,
+               index_chunks=4,
                query_gencode=11,
                threads=16,
                temp_folder='/mnt/temp',
                random_string=uuid.uuid4(),
                overwrite=False,
-               align_mode="blastx"):
-    """Align a set of reads against a reference database."""
+               compression="gzip",
+               align_mode="blastx",
+               diamond_tmpdir=None,
+               reads=None,
+               uploader=None):
+    """Align a set of reads against a reference database.
+
+    If the reads are already being downloaded, `reads` is the future
+    which will return their local path and the number of reads. All of the
+    files are kept in `temp_folder`, which is deleted by the caller.
+    If there is an `uploader`, the results are written out in the background,
+    returning the future for the upload.
+    """
 
     # Record the start time
     start_time = time.time()
@@ -67,73 +184,42 @@ def calc_abund(input_str,
     # Use the read prefix to name the output and temporary files
     read_prefix = input_str.split('/')[-1]
 
-    # Define the location of temporary file used for DIAMOND output
-    blast_fp = os.path.join(
-        temp_folder,
-        '{}-{}.blast'.format(random_string, read_prefix))
-
-    # Make sure that the temporary file does not already exist
-    assert os.path.exists(blast_fp) is False, "Alignment file already exists"
-
     # Check to see if the output already exists, if so, skip this sample
-    output_fp = output_folder.rstrip('/') + '/' + read_prefix + '.json.gz'
-    if output_fp.startswith('s3://'):
-        # Check S3
-        logging.info("Making sure that the output path doesn't already exist on S3")
-        bucket = output_fp[5:].split('/')[0]
-        prefix = '/'.join(output_fp[5:].split('/')[1:])
-        client = boto3.client('s3')
-        results = client.list_objects(Bucket=bucket, Prefix=prefix)
-        if 'Contents' in results:
-            if overwrite:
-                logging.info("Overwriting output ({})".format(output_fp))
-            else:
-                logging.info("Output already exists, skipping ({})".format(output_fp))
-                return
-    else:
-        # Check local filesystem
-        if os.path.exists(output_fp):
-            if overwrite:
-                logging.info("Overwriting output ({})".format(output_fp))
-            else:
-                logging.info("Output already exists, skipping ({})".format(output_fp))
-                return
+    # (this has already been checked for reads which are being downloaded)
+    if reads is None and skip_sample(input_str, output_folder, overwrite, compression):
+        return
 
-    # Get the reads
-    read_fp = get_reads_from_url(
-        input_str,
-        temp_folder,
-        random_string=random_string
-    )
+    # Get the reads, waiting for them if they are already being downloaded
+    if reads is not None:
+        read_fp, n_reads = reads.result()
+    else:
+        read_fp, n_reads = get_reads_from_url(
+            input_str,
+            temp_folder,
+            random_string=random_string
+        )
 
-    # Align the reads against the reference database
-    logging.info("Aligning reads")
-    align_reads(read_fp,
-                db_fp,
-                blast_fp,
-                threads=threads,
-                evalue=evalue,
-                blocks=blocks,
-                query_gencode=query_gencode,
-                align_mode=align_mode)
-
-    # Parse the alignment to get the abundance summary statistics
-    logging.info("Parsing the output")
-    parser = BlastParser(blast_fp, logging=logging)
-    parser.parse()
+    # Align the reads against the reference database, and parse the
+    # alignments to get the abundance summary statistics
+    parser, = align_and_parse(read_fp,
+                              db_fp,
+                              temp_folder,
+                              threads=threads,
+                              evalue=evalue,
+                              blocks=blocks,
+                              index_chunks=index_chunks,
+                              query_gencode=query_gencode,
+                              align_mode=align_mode,
+                              diamond_tmpdir=diamond_tmpdir)
     aligned_reads, abund_summary = parser.make_summary()
 
-    # Count the total number of reads
-    logging.info("Counting the total number of reads")
-    n_reads = count_fastq_reads(read_fp)
-    logging.info("Reads in input file: {}".format(n_reads))
-
-    os.unlink(blast_fp)
-    os.unlink(read_fp)
+    # Delete the copy of the reads, but not a local input used in place
+    if read_fp != input_str:
+        os.unlink(read_fp)
 
     # Read in the logs
     logging.info("Reading in the logs")
-    logs = open(log_fp, 'rt').readlines()
+    logs = read_logs(input_str)
 
     # Make an object with all of the results
     out = {
@@ -150,63 +236,410 @@ def calc_abund(input_str,
     }
 
     # Write out the final results as a JSON object and write them to the output folder
-    return_results(out, read_prefix, output_folder, temp_folder)
+    if uploader is not None:
+        return uploader.submit(upload_results,
+                               input_str,
+                               out,
+                               read_prefix,
+                               output_folder,
+                               temp_folder,
+                               threads=threads,
+                               compression=compression)
+    return_results(out, read_prefix, output_folder, temp_folder,
+                   threads=threads, compression=compression)
+
+
+def calc_abund_batch(inputs,
+                     db_fp,
+                     db_url,
+                     output_folder,
+                     evalue=0.00001,
+                     blocks=1,
+                     index_chunks=4,
+                     query_gencode=11,
+                     threads=16,
+                     temp_folder='/mnt/temp',
+                     random_string=uuid.uuid4(),
+                     overwrite=False,
+                     compression="gzip",
+                     align_mode="blastx",
+                     diamond_tmpdir=None):
+    """Align several sets of reads against a reference database with a single run of DIAMOND."""
+
+    # Record the start time
+    start_time = time.time()
+
+    # Skip any samples where the output already exists
+    inputs = [
+        input_str for input_str in inputs
+        if not skip_sample(input_str, output_folder, overwrite, compression)
+    ]
+    if len(inputs) == 0:
+        return
+
+    # Get the reads for each sample, in a folder of their own, downloading
+    # several of them at the same time
+    with ThreadPoolExecutor(max_workers=min(len(inputs), threads)) as downloader:
+        downloads = []
+        for ix, input_str in enumerate(inputs):
+            sample_temp_folder = os.path.join(temp_folder, str(ix))
+            os.mkdir(sample_temp_folder)
+            downloads.append(downloader.submit(
+                get_reads_from_url,
+                input_str,
+                sample_temp_folder,
+                random_string=random_string
+            ))
+
+        read_fps = []
+        n_reads = []
+        for download in downloads:
+            read_fp, n = download.result()
+            read_fps.append(read_fp)
+            n_reads.append(n)
+
+    # Combine the reads into a single file, starting each header with the
+    # index of its sample
+    logging.info("Combining the reads from {} samples".format(len(inputs)))
+    batch_read_fp = os.path.join(temp_folder, '{}-batch.fastq'.format(random_string))
+    concat_fastq(read_fps, batch_read_fp)
+    for input_str, read_fp in zip(inputs, read_fps):
+        if read_fp != input_str:
+            os.unlink(read_fp)
+
+    # Align all of the reads at once, and then split up the alignments by sample
+    parsers = align_and_parse(batch_read_fp,
+                              db_fp,
+                              temp_folder,
+                              n_samples=len(inputs),
+                              threads=threads,
+                              evalue=evalue,
+                              blocks=blocks,
+                              index_chunks=index_chunks,
+                              query_gencode=query_gencode,
+                              align_mode=align_mode,
+                              diamond_tmpdir=diamond_tmpdir)
+    os.unlink(batch_read_fp)
+
+    # Read in the logs
+    logging.info("Reading in the logs")
+    logs = read_logs(*inputs)
+
+    for ix, input_str in enumerate(inputs):
+        read_prefix = input_str.split('/')[-1]
+        aligned_reads, abund_summary = parsers[ix].make_summary()
+
+        # Make an object with all of the results
+        out = {
+            "input_path": input_str,
+            "input": read_prefix,
+            "output_folder": output_folder,
+            "logs": logs,
+            "ref_db": db_fp,
+            "ref_db_url": db_url,
+            "results": abund_summary,
+            "aligned_reads": aligned_reads,
+            "total_reads": n_reads[ix],
+            "time_elapsed": time.time() - start_time
+        }
+
+        # Write out the final results as a JSON object and write them to the output folder
+        return_results(out, read_prefix, output_folder,
+                       os.path.join(temp_folder, str(ix)), threads=threads,
+                       compression=compression)
+
+
+def calc_abund_parallel(inputs,
+                        db_fp,
+                        db_url,
+                        output_folder,
+                        parallel_samples=2,
+                        evalue=0.00001,
+                        blocks=1,
+                        index_chunks=4,
+                        query_gencode=11,
+                        threads=16,
+                        temp_folder='/mnt/temp',
+                        random_string=uuid.uuid4(),
+                        overwrite=False,
+                        compression="gzip",
+                        align_mode="blastx",
+                        diamond_tmpdir=None):
+    """Process several samples at the same time, splitting the threads between them."""
+    # Don't set aside threads for more samples than there are
+    parallel_samples = min(parallel_samples, len(inputs))
+    threads_per_sample = max(1, threads // parallel_samples)
+    logging.info("Processing {} samples at a time, with {} threads each".format(
+        parallel_samples, threads_per_sample))
+
+    # The S3 client isn't safe to share with forked processes, so each
+    # process makes its own
+    with ProcessPoolExecutor(max_workers=parallel_samples,
+                             initializer=reset_s3_client) as pool:
+        # Give each sample a temporary folder of its own
+        samples = []
+        for input_str in inputs:
+            sample_temp_folder = make_temp_folder(temp_folder)
+            future = pool.submit(calc_abund,
+                                 input_str,
+                                 db_fp,
+                                 db_url,
+                                 output_folder,
+                                 evalue=evalue,
+                                 blocks=blocks,
+                                 index_chunks=index_chunks,
+                                 query_gencode=query_gencode,
+                                 threads=threads_per_sample,
+                                 temp_folder=sample_temp_folder,
+                                 random_string=random_string,
+                                 overwrite=overwrite,
+                                 compression=compression,
+                                 align_mode=align_mode,
+                                 diamond_tmpdir=diamond_tmpdir)
+            samples.append((sample_temp_folder, future))
+
+        # Wait for each sample in turn
+        for ix, (sample_temp_folder, future) in enumerate(samples):
+            try:
+                future.result()
+            except:
+                # Stop any samples which have not started, and wait for the
+                # rest to finish before deleting their files
+                for other_folder, other_future in samples[ix + 1:]:
+                    other_future.cancel()
+                for other_folder, other_future in samples[ix + 1:]:
+                    if not other_future.cancelled():
+                        other_future.exception()
+                    logging.info("Removing temporary folder: " + other_folder)
+                    shutil.rmtree(other_folder)
+
+                # Log the error, delete the files for this sample, and exit
+                exit_and_clean_up(sample_temp_folder)
+
+            # Delete any files that were created for this sample
+            logging.info("Removing temporary folder: " + sample_temp_folder)
+            shutil.rmtree(sample_temp_folder)
+
+
+def align_and_parse(read_fp,
+                    db_fp,
+                    temp_folder,
+                    n_samples=None,
+                    threads=16,
+                    evalue=0.00001,
+                    blocks=1,
+                    index_chunks=4,
+                    query_gencode=11,
+                    align_mode="blastx",
+                    diamond_tmpdir=None):
+    """Align the reads against the reference database, parsing the alignments as they are written out.
+
+    Returns a list with one parser per sample. If `n_samples` is set, the
+    reads are from that many samples, with query IDs starting with the
+    index of the sample (see concat_fastq).
+    """
+    logging.info("Aligning reads")
+
+    # Keep the DIAMOND log in an unnamed temporary file, which is
+    # created exclusively and deleted when it is closed
+    with tempfile.TemporaryFile(dir=temp_folder) as diamond_log:
+        proc = align_reads(read_fp,
+                           db_fp,
+                           diamond_log,
+                           threads=threads,
+                           evalue=evalue,
+                           blocks=blocks,
+                           index_chunks=index_chunks,
+                           query_gencode=query_gencode,
+                           align_mode=align_mode,
+                           diamond_tmpdir=diamond_tmpdir)
+
+        logging.info("Parsing the output")
+        try:
+            if n_samples is None:
+                parsers = [BlastParser(proc.stdout, logging=logging)]
+                parsers[0].parse()
+            else:
+                parsers = parse_samples(proc.stdout, n_samples, logging=logging)
+        except:
+            proc.kill()
+            raise
+        exitcode = proc.wait()
+
+        # Add the DIAMOND log messages to the logs
+        logging.info("Output of DIAMOND:")
+        diamond_log.seek(0)
+        for line in diamond_log:
+            logging.info(line.decode("utf-8", "replace").rstrip("\n"))
+
+    # Check the exit code
+    assert exitcode == 0, "Exit code {}".format(exitcode)
+    return parsers
 
-    # Delete any temporary files that might be hanging around
-    for fp in os.listdir(temp_folder):
-        if fp.startswith(read_prefix):
-            if fp.endswith(".json.gz"):
-                continue
-            fp = os.path.join(temp_folder, fp)
-            logging.info("Removing temporary file: {}".format(fp))
-            os.unlink(fp)
+
+class SampleLogHandler(logging.Handler):
+    """Keep log messages in memory, separately for each sample."""
+
+    def emit(self, record):
+        LOG_RECORDS[LOG_SAMPLE.get()].append(
+            (record.created, self.format(record) + "\n"))
+
+
+def read_logs(*samples):
+    """Return the lines logged since the last call, for these samples or no sample in particular, clearing them from memory.
+
+    Messages about other samples, e.g. the next one being downloaded, are kept for later.
+    """
+    records = [LOG_RECORDS.pop(sample, []) for sample in (None,) + samples]
+    logs = "".join(line for created, line in heapq.merge(*records))
+
+    # Keep the end of a very long log, which is where any errors are, and
+    # note how much was left out (the full log is kept in the log file)
+    if len(logs) > MAX_LOG_SIZE:
+        start = logs.index("\n", len(logs) - MAX_LOG_SIZE) + 1
+        n_omitted = logs.count("\n", 0, start)
+        logs = "({:,} earlier lines omitted)\n".format(n_omitted) + logs[start:]
+
+    return logs.splitlines(True)
+
+
+def skip_sample(input_str, output_folder, overwrite=False, compression="gzip"):
+    """Check whether the output for a sample already exists, and should be skipped."""
+    read_prefix = input_str.split('/')[-1]
+    output_fp = output_folder.rstrip('/') + '/' + read_prefix + OUTPUT_EXTENSIONS[compression]
+
+    # Any existing output will be replaced, so there is no need to look for it
+    if overwrite:
+        logging.info("Overwriting any existing output ({})".format(output_fp))
+        return False
+
+    if output_fp.startswith('s3://'):
+        # Check S3
+        logging.info("Making sure that the output path doesn't already exist on S3")
+        bucket, key = split_s3_url(output_fp)
+        try:
+            get_s3_client().head_object(Bucket=bucket, Key=key)
+            exists = True
+        except ClientError as e:
+            if e.response['Error']['Code'] != '404':
+                raise
+            exists = False
+    else:
+        # Check local filesystem
+        exists = os.path.exists(output_fp)
+
+    if exists:
+        logging.info("Output already exists, skipping ({})".format(output_fp))
+        return True
+    return False
+
+
+def start_sample(downloader,
+                 input_str,
+                 output_folder,
+                 temp_folder,
+                 random_string=uuid.uuid4(),
+                 overwrite=False,
+                 compression="gzip"):
+    """Make a temporary folder for a sample, and start downloading its reads.
+
+    Returns the folder and the future for the downloaded reads, or None if
+    the sample will be skipped.
+    """
+    # Keep the log messages with those of this sample, not the one before it
+    token = LOG_SAMPLE.set(input_str)
+    try:
+        skip = skip_sample(input_str, output_folder, overwrite, compression)
+    finally:
+        LOG_SAMPLE.reset(token)
+    if skip:
+        return None
+
+    # Make a temporary folder for all of the files for this sample
+    sample_temp_folder = make_temp_folder(temp_folder)
+
+    # Download the reads in the background
+    reads = downloader.submit(
+        get_reads_from_url,
+        input_str,
+        sample_temp_folder,
+        random_string=random_string
+    )
+    return sample_temp_folder, reads
+
+
+def make_temp_folder(temp_folder):
+    """Make a new folder for temporary files, with a random name."""
+    new_folder = os.path.join(temp_folder, str(uuid.uuid4()))
+
+    # Don't use a folder that already exists
+    assert os.path.exists(new_folder) is False
+
+    # Make the folder
+    os.mkdir(new_folder)
+    return new_folder
+
+
+def exit_and_clean_up(temp_folder):
+    """Log the error messages and delete the temporary folder."""
+    # Capture the traceback
+    logging.info("There was an unexpected failure")
+    exc_type, exc_value, exc_traceback = sys.exc_info()
+    for line in traceback.format_tb(exc_traceback):
+        logging.info(line)
+
+    # Delete any files that were created for this sample
+    logging.info("Removing temporary folder: " + temp_folder)
+    shutil.rmtree(temp_folder)
+
+    # Exit
+    logging.info("Exit type: {}".format(exc_type))
+    logging.info("Exit code: {}".format(exc_value))
+    sys.exit(exc_value)
 
 
 def get_sra(accession, temp_folder):
     """Get the FASTQ for an SRA accession via ENA."""
     local_path = os.path.join(temp_folder, accession + ".fastq")
-    # Download from ENA via FTP
-    # See https://www.ebi.ac.uk/ena/browse/read-download for URL format
-    url = "ftp://ftp.sra.ebi.ac.uk/vol1/fastq"
-    folder1 = accession[:6]
-    url = "{}/{}".format(url, folder1)
-    if len(accession) > 9:
-        if len(accession) == 10:
-            folder2 = "00" + accession[-1]
-        elif len(accession) == 11:
-            folder2 = "0" + accession[-2:]
-        elif len(accession) == 12:
-            folder2 = accession[-3:]
-        else:
-            logging.info("This accession is too long: " + accession)
-            assert len(accession) <= 12
-        url = "{}/{}".format(url, folder2)
-    # Add the accession to the URL
-    url = "{}/{}/{}".format(url, accession, accession)
-    logging.info("Base info for downloading from ENA: " + url)
-    # There are three possible file endings
-    file_endings = ["_1.fastq.gz", "_2.fastq.gz", ".fastq.gz"]
-    # Try to download each file
-    for end in file_endings:
-        run_cmds(["curl",
-                  "-o", os.path.join(temp_folder, accession + end),
-                  url + end], catchExcept=True)
+    # Ask ENA which files it has for this accession, or if it can't be
+    # reached, try each of the file names that it might have
+    urls = get_ena_fastq_urls(accession)
+    if urls is None:
+        urls = guess_ena_fastq_urls(accession)
+    filenames = [url.split('/')[-1] for url in urls]
+    # Download each file, all at the same time, splitting each
+    # file across several connections if aria2c is available
+    if len(urls) == 0:
+        found = []
+    elif shutil.which("aria2c") is not None:
+        found = aria2c_download(urls, filenames, temp_folder)
+    else:
+        with ThreadPoolExecutor(max_workers=len(urls)) as pool:
+            downloads = [
+                pool.submit(try_download_url,
+                            url,
+                            os.path.join(temp_folder, filename))
+                for url, filename in zip(urls, filenames)
+            ]
+            found = [
+                os.path.join(temp_folder, filename)
+                for filename, download in zip(filenames, downloads)
+                if download.result()
+            ]
     # If none of those URLs downloaded, fall back to trying NCBI
-    if any([os.path.exists("{}/{}{}".format(temp_folder, accession, end))
-            for end in file_endings]):
-        # Combine them all into a single file
+    if len(found) > 0:
+        # Combine them all into a single file, decompressing each in turn
+        # (in the same order as the shell would list them)
         logging.info("Combining into a single FASTQ file")
-        with open(local_path, "wt") as fo:
-            cmd = "gunzip -c {}/{}*fastq.gz".format(temp_folder, accession)
-            gunzip = subprocess.Popen(cmd, shell=True, stdout=fo)
-            gunzip.wait()
+        with open(local_path, "wb") as fo:
+            for fp in sorted(found):
+                with open_binary(fp) as f:
+                    shutil.copyfileobj(f, fo, 1 << 20)
 
         # Clean up the temporary files
         logging.info("Cleaning up temporary files")
-        for end in file_endings:
-            fp = "{}/{}{}".format(temp_folder, accession, end)
-            if os.path.exists(fp):
-                os.unlink(fp)
+        for fp in found:
+            os.unlink(fp)
     else:
         logging.info("No files found on ENA, trying SRA")
         run_cmds([
@@ -216,13 +649,13 @@ def get_sra(accession, temp_folder):
             temp_folder, accession])
 
         # Combine any multiple files that were found
-        with open(local_path + ".temp", "wt") as fo:
-            cmd = "cat {}/{}*fastq".format(temp_folder, accession)
-            cat = subprocess.Popen(cmd, shell=True, stdout=fo)
-            cat.wait()
+        with open(local_path + ".temp", "wb") as fo:
+            for fp in sorted(glob.glob("{}/{}*fastq".format(temp_folder, accession))):
+                with open(fp, "rb") as f:
+                    shutil.copyfileobj(f, fo, 1 << 20)
 
         if os.path.exists(local_path + ".temp"):
-            run_cmds(["mv", local_path + ".temp", local_path])
+            os.replace(local_path + ".temp", local_path)
 
         # Check to see if the file was downloaded
         msg = "File could not be downloaded from SRA: {}".format(accession)
@@ -233,8 +666,64 @@ def get_sra(accession, temp_folder):
     return local_path
 
 
+def get_ena_fastq_urls(accession):
+    """Get the URLs of the FASTQ files which ENA has for an SRA accession.
+
+    Returns None if ENA could not be reached.
+    """
+    url = ("https://www.ebi.ac.uk/ena/portal/api/filereport"
+           "?accession={}&result=read_run&fields=fastq_ftp").format(accession)
+    logging.info("Listing the files on ENA: " + url)
+    try:
+        with urllib.request.urlopen(url, timeout=60) as f:
+            lines = f.read().decode().splitlines()
+    except OSError as e:
+        logging.info("Could not list the files on ENA ({})".format(e))
+        return None
+
+    # The first line is the header, followed by one line for the run, with
+    # the paths to each file separated by ';'
+    urls = []
+    for line in lines[1:]:
+        fields = line.split('\t')
+        if fields[0] != accession:
+            continue
+        urls.extend("ftp://" + path for path in fields[-1].split(';') if path)
+    logging.info("Files on ENA: {}".format(urls))
+    return urls
+
+
+def guess_ena_fastq_urls(accession):
+    """Return the URLs of every FASTQ file which ENA might have for an SRA accession."""
+    # See https://www.ebi.ac.uk/ena/browse/read-download for URL format
+    assert len(accession) <= 12, "This accession is too long: " + accession
+    # Longer accessions are also split up by their last digits
+    folder2 = {
+        10: "00" + accession[-1:],
+        11: "0" + accession[-2:],
+        12: accession[-3:],
+    }.get(len(accession))
+    folders = [ENA_FASTQ_URL, accession[:6], folder2, accession, accession]
+    url = "/".join(folder for folder in folders if folder is not None)
+    logging.info("Base info for downloading from ENA: " + url)
+    return [url + end for end in ENA_FILE_ENDINGS]
+
+
 def get_reads_from_url(input_str, temp_folder, random_string=uuid.uuid4()):
-    """Get a set of reads from a URL -- return the downloaded filepath."""
+    """Get a set of reads from a URL -- return the downloaded filepath and the number of reads.
+
+    A local file is used in place, rather than copied, if its headers do not need to be changed.
+    The log messages are kept with those of this sample, even if it is downloaded in the background.
+    """
+    token = LOG_SAMPLE.set(input_str)
+    try:
+        return download_reads(input_str, temp_folder, random_string=random_string)
+    finally:
+        LOG_SAMPLE.reset(token)
+
+
+def download_reads(input_str, temp_folder, random_string=uuid.uuid4()):
+    """Download a set of reads (see get_reads_from_url)."""
     logging.info("Getting reads from {}".format(input_str))
 
     filename = input_str.split('/')[-1]
@@ -247,6 +736,15 @@ def get_reads_from_url(input_str, temp_folder, random_string=uuid.uuid4()):
         logging.info("Treating as local path")
         msg = "Input file does not exist ({})".format(input_str)
         assert os.path.exists(input_str), msg
+
+        # Use the file where it is, if its headers don't need to be changed
+        if not input_str.endswith('.gz'):
+            n_reads = check_fastq_headers(input_str)
+            if n_reads is not None:
+                logging.info("Using FASTQ headers as they are")
+                logging.info("Reads in input file: {}".format(n_reads))
+                return input_str, n_reads
+
         logging.info("Copying to temporary folder, cleaning up headers")
 
         # Add a random string to the filename
@@ -255,22 +753,41 @@ def get_reads_from_url(input_str, temp_folder, random_string=uuid.uuid4()):
         local_path = '/'.join(local_path)
 
         # Make the FASTQ headers unique
-        clean_fastq_headers(input_str, local_path)
+        n_reads = clean_fastq_headers(input_str, local_path)
+        logging.info("Reads in input file: {}".format(n_reads))
 
-        return local_path
+        return local_path, n_reads
 
-    # Get files from AWS S3
+    # Stream files from AWS S3, writing out the reads with clean headers
+    # as they are downloaded, rather than saving a copy of the raw file
     if input_str.startswith('s3://'):
-        logging.info("Getting reads from S3")
-        run_cmds([
-            'aws', 's3', 'cp', '--quiet', '--sse',
-            'AES256', input_str, temp_folder
-            ])
+        logging.info("Streaming reads from S3")
+
+        # Reads are written out uncompressed
+        if local_path.endswith('.gz'):
+            local_path = local_path[:-3]
+        new_path = local_path.split('/')
+        new_path[-1] = "{}-{}".format(random_string, new_path[-1])
+        new_path = '/'.join(new_path)
+
+        logging.info(
+            "Streaming {} to {}, cleaning up FASTQ headers".format(
+                input_str, new_path
+                )
+            )
+        n_reads = stream_s3_reads(input_str, new_path, gzipped=input_str.endswith('.gz'))
+        logging.info("Reads in input file: {}".format(n_reads))
+        return new_path, n_reads
 
     # Get files from an FTP server
     elif input_str.startswith('ftp://'):
         logging.info("Getting reads from FTP")
-        run_cmds(['wget', '-P', temp_folder, input_str])
+        if shutil.which("aria2c") is not None:
+            found = aria2c_download([input_str], [filename], temp_folder)
+            msg = "File could not be downloaded: {}".format(input_str)
+            assert len(found) == 1, msg
+        else:
+            download_url(input_str, local_path)
 
     # Get files from SRA
     elif input_str.startswith('sra://'):
@@ -290,17 +807,128 @@ def get_reads_from_url(input_str, temp_folder, random_string=uuid.uuid4()):
             local_path, new_path
             )
         )
-    clean_fastq_headers(local_path, new_path)
+    n_reads = clean_fastq_headers(local_path, new_path)
+    logging.info("Reads in input file: {}".format(n_reads))
     logging.info("Deleting old file: {}".format(local_path))
     os.unlink(local_path)
-    return new_path
+    return new_path, n_reads
+
 
+def stream_s3_reads(s3_url, fp_out, gzipped=False):
+    """Download reads from S3, saving them with clean headers as they arrive.
 
-def get_reference_database(ref_db, temp_folder, random_string=uuid.uuid4()):
+    Returns the number of reads.
+    """
+    bucket, key = split_s3_url(s3_url)
+    body = get_s3_client().get_object(Bucket=bucket, Key=key)['Body']
+
+    # Copy the download into a pipe in the background
+    read_fd, write_fd = os.pipe()
+    with ThreadPoolExecutor(max_workers=1) as pool:
+        copy = pool.submit(copy_to_pipe, body, write_fd)
+
+        # Decompress the reads in a separate process, as they arrive, using
+        # pigz (which reads, writes and checks on separate threads) if available
+        proc = None
+        if gzipped:
+            if shutil.which('pigz') is not None:
+                decompress = ['pigz', '-dc']
+            else:
+                decompress = ['gunzip', '-c']
+            proc = subprocess.Popen(decompress,
+                                    stdin=read_fd,
+                                    stdout=subprocess.PIPE)
+            os.close(read_fd)
+            f_in = proc.stdout
+        else:
+            f_in = os.fdopen(read_fd, 'rb')
+
+        n_reads = clean_fastq_headers(f_in, fp_out)
+
+        # Check the exit code, and that the whole file was downloaded
+        if proc is not None:
+            exitcode = proc.wait()
+            assert exitcode == 0, "Exit code {}".format(exitcode)
+        copy.result()
+
+    return n_reads
+
+
+def copy_to_pipe(f_in, write_fd):
+    """Copy the contents of a file object into a pipe, closing it at the end."""
+    with os.fdopen(write_fd, 'wb') as f_out:
+        shutil.copyfileobj(f_in, f_out, 1 << 20)
+
+
+def download_url(url, local_path):
+    """Download a file from a URL (e.g. FTP) to a local path."""
+    logging.info("Downloading {} to {}".format(url, local_path))
+    with urllib.request.urlopen(url) as f_in:
+        with open(local_path, 'wb') as f_out:
+            shutil.copyfileobj(f_in, f_out, 1 << 20)
+
+
+def try_download_url(url, local_path):
+    """Download a file from a URL, returning False if it could not be downloaded."""
+    try:
+        download_url(url, local_path)
+    except OSError as e:
+        # URLError is an OSError, as are timeouts and dropped connections
+        # part of the way through the download
+        logging.info("Could not download {} ({})".format(url, e))
+        if os.path.exists(local_path):
+            os.unlink(local_path)
+        return False
+    return True
+
+
+def aria2c_download(urls, filenames, temp_folder, connections=16):
+    """Download a set of files at once with aria2c, using several connections for each.
+
+    Returns the paths of the files which were downloaded in full.
+    """
+    # List each URL, followed by the name to save it as
+    input_fp = os.path.join(temp_folder, "aria2c-input.txt")
+    with open(input_fp, "wt") as f:
+        for url, filename in zip(urls, filenames):
+            f.write("{}\n  out={}\n".format(url, filename))
+
+    # Files which do not exist are expected, so failures are allowed
+    run_cmds(["aria2c",
+              "-x", str(connections),
+              "-s", str(connections),
+              "-j", str(len(urls)),
+              "--file-allocation=none",
+              "--console-log-level=warn",
+              "--summary-interval=0",
+              "-d", temp_folder,
+              "-i", input_fp], catchExcept=True)
+    os.unlink(input_fp)
+
+    found = []
+    for filename in filenames:
+        fp = os.path.join(temp_folder, filename)
+        # A control file is left next to any download which did not finish
+        if os.path.exists(fp + ".aria2"):
+            logging.info("Incomplete download: " + fp)
+            os.unlink(fp + ".aria2")
+            if os.path.exists(fp):
+                os.unlink(fp)
+        elif os.path.exists(fp):
+            found.append(fp)
+    return found
+
+
+def get_reference_database(ref_db, temp_folder, random_string=uuid.uuid4(),
+                           threads=16, cache_dir=None):
     """Get a reference database."""
     assert ref_db.endswith('.dmnd'), "Ref DB must be *.dmnd ({})".format(ref_db)
-    # Get files from AWS S3
-    if ref_db.startswith('s3://'):
+    # Get files from AWS S3, keeping a copy in the cache folder if one is given
+    if ref_db.startswith('s3://') and cache_dir is not None:
+        return get_cached_database(ref_db, cache_dir, random_string=random_string,
+                                   threads=threads)
+
+    elif ref_db.startswith('s3://'):
         logging.info("Getting reference database from S3: " + ref_db)
 
         # Save the database to a local path with a random string prefix, to avoid collision
@@ -309,7 +937,10 @@ def get_reference_database(ref_db, temp_folder, random_string=uuid.uuid4()):
         assert os.path.exists(local_fp) is False
 
         logging.info("Saving database to " + local_fp)
-        run_cmds(['aws', 's3', 'cp', '--quiet', '--sse', 'AES256', ref_db, local_fp])
+        bucket, key = split_s3_url(ref_db)
+        get_s3_client().download_file(
+            bucket, key, local_fp,
+            Config=s3_transfer_config(threads, part_size=S3_DB_PART_SIZE))
 
         return local_fp[:-5]
 
@@ -321,86 +952,197 @@ def get_reference_database(ref_db, temp_folder, random_string=uuid.uuid4()):
         return ref_db
 
 
+def get_cached_database(ref_db, cache_dir, random_string=uuid.uuid4(), threads=16):
+    """Get a reference database from S3, reusing the cached copy if it is unchanged."""
+    bucket, key = split_s3_url(ref_db)
+    # Name the cached copy after the whole URL, so that databases with the
+    # same file name in different places are kept apart
+    url_hash = hashlib.sha1(ref_db.encode()).hexdigest()[:16]
+    local_fp = os.path.join(cache_dir, "{}-{}".format(url_hash, ref_db.split('/')[-1]))
+    etag_fp = local_fp + '.etag'
+
+    # The ETag changes whenever the object on S3 changes
+    etag = get_s3_client().head_object(Bucket=bucket, Key=key)['ETag']
+
+    # Only let one process at a time check and update the cached copy, so
+    # that runs sharing the cache folder only download the database once
+    with open(local_fp + '.lock', 'wb') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+
+        if os.path.exists(local_fp) and os.path.exists(etag_fp):
+            with open(etag_fp, 'rt') as f:
+                if f.read() == etag:
+                    logging.info("Using cached reference database: " + local_fp)
+                    return local_fp[:-5]
+
+        # Download to a temporary name, so that an incomplete file is never used
+        logging.info("Saving database to cache: " + local_fp)
+        temp_fp = os.path.join(cache_dir, "{}.{}".format(random_string, ref_db.split('/')[-1]))
+        get_s3_client().download_file(
+            bucket, key, temp_fp,
+            Config=s3_transfer_config(threads, part_size=S3_DB_PART_SIZE))
+        os.replace(temp_fp, local_fp)
+        with open(etag_fp, 'wt') as f:
+            f.write(etag)
+
+    return local_fp[:-5]
+
+
+def prefetch_database(db_fp):
+    """Start reading the reference database into the page cache, ahead of alignment."""
+    if not db_fp.endswith('.dmnd'):
+        db_fp = db_fp + '.dmnd'
+
+    # The OS reads the file in the background, so that every run of
+    # DIAMOND loads the database from memory
+    if hasattr(os, 'posix_fadvise') and os.path.exists(db_fp):
+        logging.info("Prefetching reference database: " + db_fp)
+        with open(db_fp, 'rb') as f:
+            os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_WILLNEED)
+
+
+def available_memory_gb():
+    """Return the amount of memory which is available (in Gb)."""
+    # Use the estimate from the kernel, which counts reclaimable caches
+    if os.path.exists('/proc/meminfo'):
+        with open('/proc/meminfo', 'rt') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) / (1024. * 1024.)
+
+    return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE') / (1024. ** 3)
+
+
+def size_diamond_memory(blocks=None, index_chunks=None, parallel_samples=1):
+    """Pick the DIAMOND block size and number of index chunks to fit the available memory."""
+    # Share the memory between any samples which are aligned at the same time
+    memory_gb = available_memory_gb() / parallel_samples
+    logging.info("Memory available for each alignment: {:.1f}Gb".format(memory_gb))
+
+    # DIAMOND uses roughly 6Gb for each block of the reference
+    if blocks is None:
+        blocks = int(min(max(memory_gb // 6, 1), 12))
+
+    # Processing the seed index in a single chunk is much faster, but uses
+    # more memory, so only do so when there is at least twice the memory needed
+    if index_chunks is None:
+        index_chunks = 1 if memory_gb >= 2 * 6 * blocks else 4
+
+    logging.info("Aligning with -b {} and -c {}".format(blocks, index_chunks))
+    return blocks, index_chunks
+
+
 def align_reads(read_fp,
                 db_fp,
-                blast_fp,
+                stderr,
                 threads=16,
                 evalue=0.00001,
                 blocks=1,
+                index_chunks=4,
                 query_gencode=11,
-                align_mode="blastx"):
-    """Align the reads against the reference database."""
+                align_mode="blastx",
+                diamond_tmpdir=None):
+    """Start aligning the reads against the reference database.
+
+    Returns the running DIAMOND process, which writes the alignments to
+    STDOUT and its log messages to `stderr`. DIAMOND writes its own temporary
+    files to `diamond_tmpdir`, if set.
+    """
+    commands = ["diamond",
+                align_mode,
+                "--threads",
+                str(threads),
+                "--query",
+                read_fp,
+                "--db",
+                db_fp,
+                "--outfmt",
+                "6",
+                "qseqid",
+                "sseqid",
+                "slen",
+                "sstart",
+                "send",
+                "--top",
+                "0",
+                "--evalue",
+                str(evalue),
+                "-b",
+                str(blocks),
+                "-c",
+                str(index_chunks)]
     if align_mode == "blastx":
-        run_cmds(["diamond",
-                  "blastx",
-                  "--threads",
-                  str(threads),
-                  "--query",
-                  read_fp,
-                  "--db",
-                  db_fp,
-                  "--outfmt",
-                  "6",
-                  "qseqid",
-                  "sseqid",
-                  "slen",
-                  "sstart",
-                  "send",
-                  "qseq",
-                  "--out",
-                  blast_fp,
-                  "--top",
-                  "0",
-                  "--evalue",
-                  str(evalue),
-                  "-b",
-                  str(blocks),
-                  "--query-gencode",
-                  str(query_gencode)])
-    elif align_mode == "blastp":
-        run_cmds(["diamond",
-                  "blastp",
-                  "--threads",
-                  str(threads),
-                  "--query",
-                  read_fp,
-                  "--db",
-                  db_fp,
-                  "--outfmt",
-                  "6",
-                  "qseqid",
-                  "sseqid",
-                  "slen",
-                  "sstart",
-                  "send",
-                  "qseq",
-                  "--out",
-                  blast_fp,
-                  "--top",
-                  "0",
-                  "--evalue",
-                  str(evalue),
-                  "-b",
-                  str(blocks)])
-
-
-def return_results(out, read_prefix, output_folder, temp_folder):
+        # For BLASTX, specify the genetic code
+        commands = commands + [
+            "--query-gencode",
+            str(query_gencode)
+        ]
+    if diamond_tmpdir is not None:
+        commands = commands + [
+            "--tmpdir",
+            diamond_tmpdir
+        ]
+
+    if logging.getLogger().isEnabledFor(logging.INFO):
+        logging.info("Commands:")
+        logging.info(' '.join(commands))
+    return subprocess.Popen(commands,
+                            stdout=subprocess.PIPE,
+                            stderr=stderr,
+                            bufsize=1 << 20)
+
+
+def return_results(out, read_prefix, output_folder, temp_folder, threads=16,
+                   compression="gzip"):
     """Write out the final results as a JSON object and write them to the output folder."""
-    # Make a temporary file
-    temp_fp = os.path.join(temp_folder, read_prefix + '.json')
-    with open(temp_fp, 'wt') as fo:
-        json.dump(out, fo)
-    # Compress the output
-    run_cmds(['gzip', temp_fp])
-    temp_fp = temp_fp + '.gz'
+    if orjson is not None:
+        payload = orjson.dumps(out, option=orjson.OPT_SERIALIZE_NUMPY)
+    else:
+        payload = json.dumps(out, separators=(',', ':')).encode()
+
+    # Make a temporary file, compressing the output as it is written
+    temp_fp = os.path.join(temp_folder, read_prefix + OUTPUT_EXTENSIONS[compression])
+    if compression == "zstd":
+        # Compress with zstd, using all of the cores
+        cctx = zstandard.ZstdCompressor(level=3, threads=-1)
+        with open(temp_fp, 'wb') as f:
+            with cctx.stream_writer(f, closefd=False) as fo:
+                fo.write(payload)
+    elif igzip_threaded is not None:
+        # Compress blocks of the output in parallel, like pigz
+        with igzip_threaded.open(temp_fp, 'wb', threads=threads) as fo:
+            fo.write(payload)
+    else:
+        with gzip.open(temp_fp, 'wb', compresslevel=6) as fo:
+            fo.write(payload)
 
     if output_folder.startswith('s3://'):
-        # Copy to S3
-        run_cmds(['aws', 's3', 'cp', '--quiet', '--sse', 'AES256', temp_fp, output_folder])
+        # Copy to S3, uploading the parts of large files in parallel
+        bucket, key = split_s3_url(
+            output_folder.rstrip('/') + '/' + os.path.basename(temp_fp))
+        logging.info("Uploading {} to s3://{}/{}".format(temp_fp, bucket, key))
+        get_s3_client().upload_file(
+            temp_fp, bucket, key,
+            ExtraArgs={'ServerSideEncryption': 'AES256'},
+            Config=s3_transfer_config(threads))
         os.unlink(temp_fp)
     else:
-        # Copy to local folder
-        run_cmds(['mv', temp_fp, output_folder])
+        # Move to local folder
+        shutil.move(temp_fp, os.path.join(output_folder, os.path.basename(temp_fp)))
+
+
+def upload_results(input_str, *args, **kwargs):
+    """Write out the results for a sample from a background thread (see return_results).
+
+    The logs for the sample are already in its results, so the messages
+    logged here are only written to the log file.
+    """
+    token = LOG_SAMPLE.set(input_str)
+    try:
+        return_results(*args, **kwargs)
+    finally:
+        LOG_SAMPLE.reset(token)
+        LOG_RECORDS.pop(input_str, None)
 
 
 if __name__ == "__main__":
@@ -420,6 +1162,17 @@ if __name__ == "__main__":
                         type=str,
                         help="""Folder to place results.
                                 (Supported: s3://, or local path).""")
+    parser.add_argument("--db-cache-dir",
+                        type=str,
+                        default=None,
+                        help="""Folder used to keep reference databases downloaded from S3,
+                                which are reused until they change on S3.""")
+    parser.add_argument("--compression",
+                        type=str,
+                        default="gzip",
+                        choices=list(OUTPUT_EXTENSIONS),
+                        help="""Compress the results with gzip (.json.gz, default)
+                                or zstd (.json.zst).""")
     parser.add_argument("--overwrite",
                         action="store_true",
                         help="""Overwrite output files. Off by default.""")
@@ -429,9 +1182,15 @@ if __name__ == "__main__":
                         help="E-value used to filter alignments.")
     parser.add_argument("--blocks",
                         type=int,
-                        default=5,
+                        default=None,
                         help="""Number of blocks used when aligning.
-                              Value relates to the amount of memory used.""")
+                              Value relates to the amount of memory used.
+                              By default, this is set from the memory available.""")
+    parser.add_argument("--index-chunks",
+                        type=int,
+                        default=None,
+                        help="""Number of chunks used for the seed index when aligning.
+                              By default, 1 if there is plenty of memory, otherwise 4.""")
     parser.add_argument("--align-mode",
                         type=str,
                         default="blastx",
@@ -448,12 +1207,35 @@ if __name__ == "__main__":
                         type=str,
                         default='/share',
                         help="Folder used for temporary files (and ramdisk, if specified).")
+    parser.add_argument("--diamond-tmpdir",
+                        type=str,
+                        default=None,
+                        help="""Folder used by DIAMOND for its own temporary files, e.g.
+                              on a local disk rather than the ramdisk.""")
+    parser.add_argument("--parallel-samples",
+                        type=int,
+                        default=1,
+                        help="""Number of inputs to align at the same time, each
+                              using an equal share of --threads.""")
+    parser.add_argument("--batch-inputs",
+                        action="store_true",
+                        help="""Align all of the inputs with a single run of DIAMOND,
+                              so that the reference database is only loaded once.""")
 
     args = parser.parse_args()
 
     # Make sure that the align mode is either blastx or blastp
     assert args.align_mode in ["blastx", "blastp"]
 
+    # Make sure that zstd compression is available, if requested
+    if args.compression == "zstd":
+        assert zstandard is not None, "The zstandard module is needed for zstd compression"
+
+    # Make sure that DIAMOND's temporary folder exists, before any downloads start
+    if args.diamond_tmpdir is not None:
+        msg = "Folder does not exist ({})".format(args.diamond_tmpdir)
+        assert os.path.isdir(args.diamond_tmpdir), msg
+
     # Set a random string, which will be appended to all temporary files
     random_string = uuid.uuid4()
 
@@ -471,69 +1253,183 @@ if __name__ == "__main__":
     consoleHandler = logging.StreamHandler()
     consoleHandler.setFormatter(logFormatter)
     rootLogger.addHandler(consoleHandler)
+    # Also keep in memory, to add to the output
+    bufferHandler = SampleLogHandler()
+    bufferHandler.setFormatter(logFormatter)
+    rootLogger.addHandler(bufferHandler)
 
     # Get the reference database
     db_fp = get_reference_database(
         args.ref_db,
         args.temp_folder,
-        random_string=random_string
+        random_string=random_string,
+        threads=args.threads,
+        cache_dir=args.db_cache_dir
     )
     logging.info("Reference database: " + db_fp)
+    prefetch_database(db_fp)
 
-    # Align each of the inputs and calculate the overall abundance
-    for input_str in args.input.split(','):
-        logging.info("Processing input argument: " + input_str)
-        
-        # Make a temporary folder for all of the files for this sample
-        sample_temp_folder = os.path.join(args.temp_folder, str(uuid.uuid4()))
-        
-        # Don't use a folder that already exists
-        assert os.path.exists(sample_temp_folder) is False
+    # Fit the DIAMOND settings to the memory available, unless they were given
+    args.blocks, args.index_chunks = size_diamond_memory(
+        args.blocks,
+        args.index_chunks,
+        parallel_samples=1 if args.batch_inputs else args.parallel_samples
+    )
 
-        # Make the folder
-        os.mkdir(sample_temp_folder)
+    inputs = args.input.split(',')
 
-        # Capture in a try statement
+    if args.batch_inputs:
+        # Align all of the inputs at once, in a single temporary folder
+        batch_temp_folder = make_temp_folder(args.temp_folder)
         try:
-            calc_abund(input_str,             # ID for single sample to process
-                       db_fp,                 # Local path to DB
-                       args.ref_db,           # URL of ref DB, used for logging
-                       args.output_folder,    # Place to put results
-                       evalue=args.evalue,
-                       blocks=args.blocks,
-                       query_gencode=args.query_gencode,
-                       threads=args.threads,
-                       temp_folder=sample_temp_folder,
-                       random_string=random_string,
-                       overwrite=args.overwrite,
-                       align_mode=args.align_mode)
+            calc_abund_batch(inputs,
+                             db_fp,
+                             args.ref_db,
+                             args.output_folder,
+                             evalue=args.evalue,
+                             blocks=args.blocks,
+                             index_chunks=args.index_chunks,
+                             query_gencode=args.query_gencode,
+                             threads=args.threads,
+                             temp_folder=batch_temp_folder,
+                             random_string=random_string,
+                             overwrite=args.overwrite,
+                             compression=args.compression,
+                             align_mode=args.align_mode,
+                             diamond_tmpdir=args.diamond_tmpdir)
         except:
-            # There was some error
-            # Capture the traceback
-            logging.info("There was an unexpected failure")
-            exc_type, exc_value, exc_traceback = sys.exc_info()
-            for line in traceback.format_tb(exc_traceback):
-                logging.info(line)
-
-            # Delete any files that were created for this sample
-            logging.info("Removing temporary folder: " + sample_temp_folder)
-            shutil.rmtree(sample_temp_folder)
-
-            # Exit
-            logging.info("Exit type: {}".format(exc_type))
-            logging.info("Exit code: {}".format(exc_value))
-            sys.exit(exc_value)
+            exit_and_clean_up(batch_temp_folder)
+
+        # Delete any files that were created for these samples
+        logging.info("Removing temporary folder: " + batch_temp_folder)
+        shutil.rmtree(batch_temp_folder)
+
+    elif args.parallel_samples > 1:
+        # Align several of the inputs at the same time
+        calc_abund_parallel(inputs,
+                            db_fp,
+                            args.ref_db,
+                            args.output_folder,
+                            parallel_samples=args.parallel_samples,
+                            evalue=args.evalue,
+                            blocks=args.blocks,
+                            index_chunks=args.index_chunks,
+                            query_gencode=args.query_gencode,
+                            threads=args.threads,
+                            temp_folder=args.temp_folder,
+                            random_string=random_string,
+                            overwrite=args.overwrite,
+                            compression=args.compression,
+                            align_mode=args.align_mode,
+                            diamond_tmpdir=args.diamond_tmpdir)
 
-        # Delete any files that were created for this sample
-        logging.info("Removing temporary folder: " + sample_temp_folder)
-        shutil.rmtree(sample_temp_folder)
+    else:
+        # Download the reads for each input in a background thread, so that the
+        # next input is downloaded while the current one is being aligned
+        downloader = ThreadPoolExecutor(max_workers=1)
+        # Likewise, write out the results for each input in the background,
+        # while the next one is being aligned
+        uploader = ThreadPoolExecutor(max_workers=1)
+        upload = None
+        next_sample = start_sample(downloader,
+                                   inputs[0],
+                                   args.output_folder,
+                                   args.temp_folder,
+                                   random_string=random_string,
+                                   overwrite=args.overwrite,
+                                   compression=args.compression)
+
+        # Align each of the inputs and calculate the overall abundance
+        for ix, input_str in enumerate(inputs):
+            logging.info("Processing input argument: " + input_str)
+            sample = next_sample
+
+            # Start fetching the next input
+            next_sample = None
+            if ix + 1 < len(inputs):
+                next_sample = start_sample(downloader,
+                                           inputs[ix + 1],
+                                           args.output_folder,
+                                           args.temp_folder,
+                                           random_string=random_string,
+                                           overwrite=args.overwrite,
+                                           compression=args.compression)
+
+            # Skip this input if the output already exists
+            if sample is None:
+                continue
+            sample_temp_folder, reads = sample
+
+            # Capture in a try statement
+            uploading = None
+            try:
+                uploading = calc_abund(input_str, # ID for single sample to process
+                           db_fp,                 # Local path to DB
+                           args.ref_db,           # URL of ref DB, used for logging
+                           args.output_folder,    # Place to put results
+                           evalue=args.evalue,
+                           blocks=args.blocks,
+                           index_chunks=args.index_chunks,
+                           query_gencode=args.query_gencode,
+                           threads=args.threads,
+                           temp_folder=sample_temp_folder,
+                           random_string=random_string,
+                           overwrite=args.overwrite,
+                           compression=args.compression,
+                           align_mode=args.align_mode,
+                           diamond_tmpdir=args.diamond_tmpdir,
+                           reads=reads,
+                           uploader=uploader)
+
+                # Wait for the results of the previous input to be written out
+                if upload is not None:
+                    upload[1].result()
+            except:
+                # Wait for the next input to finish downloading, and delete it
+                if next_sample is not None:
+                    next_sample[1].exception()
+                    logging.info("Removing temporary folder: " + next_sample[0])
+                    shutil.rmtree(next_sample[0])
+
+                # Wait for the results which are being written out, and
+                # delete the files for the previous input
+                if uploading is not None:
+                    uploading.exception()
+                if upload is not None:
+                    upload[1].exception()
+                    logging.info("Removing temporary folder: " + upload[0])
+                    shutil.rmtree(upload[0])
+
+                # Log the error, delete the files for this sample, and exit
+                exit_and_clean_up(sample_temp_folder)
+
+            # Delete any files that were created for the previous input
+            if upload is not None:
+                logging.info("Removing temporary folder: " + upload[0])
+                shutil.rmtree(upload[0])
+            upload = (sample_temp_folder, uploading)
+
+        # Wait for the results of the last input to be written out
+        if upload is not None:
+            try:
+                upload[1].result()
+            except:
+                exit_and_clean_up(upload[0])
+
+            # Delete any files that were created for this input
+            logging.info("Removing temporary folder: " + upload[0])
+            shutil.rmtree(upload[0])
+
+        downloader.shutdown()
+        uploader.shutdown()
 
     # Delete any other files that were created in this process
     # This should only be the reference database, if it was downloaded
-    for fp in os.listdir(args.temp_folder):
-        if fp.startswith(str(random_string)):
-            logging.info("Deleting temporary file {}".format(fp))
-            os.unlink(os.path.join(args.temp_folder, fp))
+    with os.scandir(args.temp_folder) as entries:
+        for entry in entries:
+            if entry.name.startswith(str(random_string)) and entry.is_file():
+                logging.info("Deleting temporary file {}".format(entry.name))
+                os.unlink(entry.path)
 
     # Stop logging
     logging.info("Done")
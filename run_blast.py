@@ -1,41 +1,208 @@
 #!/usr/bin/env python3
 """Run DIAMOND and return the BLAST alignment file for two FASTA files."""
 
+import io
 import os
 import sys
 import time
 import json
+import gzip
+import queue
 import uuid
+import boto3
+import fcntl
+import hashlib
 import shutil
 import logging
+import logging.handlers
 import argparse
 import traceback
+import contextlib
+import collections
+import tempfile
+import threading
 import subprocess
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from boto3.s3.transfer import TransferConfig
+from botocore.exceptions import ClientError
+from botocore.exceptions import BotoCoreError
+
+# ioctl which makes a copy-on-write clone of a file (on e.g. XFS or Btrfs)
+FICLONE = 0x40049409
+
+# fcntl which sets the size of a pipe's buffer (Linux only), and the size
+# used for the output of commands
+F_SETPIPE_SZ = 1031
+PIPE_SIZE = 1024 * 1024
+
+# Background thread which writes out the log messages, once it is set up
+LOG_LISTENER = None
+
+# Client used to access S3, set up when it is first needed (the lock stops
+# two threads from setting it up at once, which boto3 doesn't allow)
+S3_CLIENT = None
+S3_CLIENT_LOCK = threading.Lock()
+
+# Files on S3 are transferred in parts of this size (in bytes)
+S3_PART_SIZE = 8 * 1024 * 1024
+
+# Files on S3 larger than this (in bytes) are streamed by fetching several
+# ranges of S3_RANGE_SIZE at a time
+S3_PARALLEL_SIZE = 128 * 1024 * 1024
+S3_RANGE_SIZE = 16 * 1024 * 1024
+
+# Files written to S3 are encrypted at rest
+S3_UPLOAD_ARGS = {'ServerSideEncryption': 'AES256'}
+
+
+def get_s3_client():
+    """Return the S3 client, reusing it after it has been set up once."""
+    global S3_CLIENT
+    with S3_CLIENT_LOCK:
+        if S3_CLIENT is None:
+            S3_CLIENT = boto3.client('s3')
+    return S3_CLIENT
+
+
+def split_s3_url(url):
+    """Split an S3 URL into the bucket and key."""
+    bucket, _, key = url[5:].partition('/')
+    return bucket, key
+
+
+def s3_transfer_config(threads=16):
+    """Set up S3 transfers to move the parts of large files in parallel."""
+    return TransferConfig(multipart_threshold=S3_PART_SIZE,
+                          multipart_chunksize=S3_PART_SIZE,
+                          max_concurrency=threads)
+
+
+def check_s3_writable(url):
+    """Make sure a file can be written to an S3 URL, by writing and deleting an empty file next to it."""
+    bucket, key = split_s3_url(url)
+    # Use a new name, so that no existing file is replaced
+    probe_key = "{}.{}.probe".format(key, uuid.uuid4())
+    get_s3_client().put_object(Bucket=bucket, Key=probe_key, Body=b"", **S3_UPLOAD_ARGS)
+    # Writing is all that is needed, so only warn if the file can't be deleted
+    try:
+        get_s3_client().delete_object(Bucket=bucket, Key=probe_key)
+    except (ClientError, BotoCoreError) as e:
+        logging.warning("Could not delete s3://{}/{} ({})".format(bucket, probe_key, e))
+
+
+def get_s3_range(bucket, key, start, end):
+    """Return the bytes from `start` to `end` (inclusive) of a file on S3."""
+    r = get_s3_client().get_object(Bucket=bucket,
+                                   Key=key,
+                                   Range="bytes={}-{}".format(start, end))
+    return r['Body'].read()
+
+
+def iter_s3_ranges(bucket, key, size, threads=16):
+    """Yield the contents of a file on S3 in order, fetching several ranges at a time."""
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        # Keep up to `threads` ranges downloading ahead of the one being read
+        pending = collections.deque()
+        try:
+            for start in range(0, size, S3_RANGE_SIZE):
+                end = min(start + S3_RANGE_SIZE, size) - 1
+                pending.append(pool.submit(get_s3_range, bucket, key, start, end))
+                if len(pending) >= threads:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+        finally:
+            # If reading stops early, don't start downloading any more ranges
+            # (the pool still waits for those which have already started)
+            for future in pending:
+                future.cancel()
+
+
+class ChunkReader(io.RawIOBase):
+    """File object which reads from an iterator of byte strings."""
+
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.chunk = memoryview(b"")
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        # Move on to the next chunk once this one has been read
+        while len(self.chunk) == 0:
+            chunk = next(self.chunks, None)
+            if chunk is None:
+                return 0
+            self.chunk = memoryview(chunk)
+        n = min(len(b), len(self.chunk))
+        b[:n] = self.chunk[:n]
+        self.chunk = self.chunk[n:]
+        return n
+
+    def close(self):
+        # Stop fetching any more chunks
+        self.chunks.close()
+        super().close()
 
 
 def run_cmds(commands, retry=0, catchExcept=False):
     """Run commands and write out the log, combining STDOUT & STDERR."""
-    logging.info("Commands:")
-    logging.info(' '.join(commands))
-    p = subprocess.Popen(commands,
-                         stdout=subprocess.PIPE,
-                         stderr=subprocess.STDOUT)
-    stdout, stderr = p.communicate()
+    # Only format the messages if they will be logged
+    log_info = logging.getLogger().isEnabledFor(logging.INFO)
+    if log_info:
+        logging.info("Commands:")
+        logging.info(' '.join(commands))
+    # A larger pipe lets the command write bursts of output without
+    # waiting for them to be read
+    read_fd, write_fd = os.pipe()
+    try:
+        fcntl.fcntl(read_fd, F_SETPIPE_SZ, PIPE_SIZE)
+    except OSError:
+        pass
+    output = os.fdopen(read_fd, 'rb')
+    # Giving the full path of the program, and leaving open file descriptors
+    # alone (Python opens them as non-inheritable), lets Python start the
+    # process with posix_spawn, without copying the page tables of this process
+    try:
+        p = subprocess.Popen(commands,
+                             executable=shutil.which(commands[0]) or commands[0],
+                             close_fds=False,
+                             stdout=write_fd,
+                             stderr=write_fd)
+    except:
+        output.close()
+        raise
+    finally:
+        os.close(write_fd)
+    # Log the output as it is written, rather than holding all of it
+    # in memory until the command finishes, with one message for all
+    # of the complete lines which are ready at a time
+    started = False
+    partial = b""
+    for chunk in iter(lambda: output.read1(1 << 16), b""):
+        if not log_info:
+            continue
+        lines, newline, partial = (partial + chunk).rpartition(b"\n")
+        if not newline:
+            continue
+        if not started:
+            logging.info("Standard output of subprocess:")
+            started = True
+        logging.info(lines.decode("utf-8", "replace"))
+    if partial:
+        if not started:
+            logging.info("Standard output of subprocess:")
+        logging.info(partial.decode("utf-8", "replace"))
+    output.close()
     exitcode = p.wait()
-    if stdout:
-        logging.info("Standard output of subprocess:")
-        for line in stdout.decode("utf-8").split('\n'):
-            logging.info(line)
-    if stderr:
-        logging.info("Standard error of subprocess:")
-        for line in stderr.decode("utf-8").split('\n'):
-            logging.info(line)
 
     # Check the exit code
     if exitcode != 0 and retry > 0:
         msg = "Exit code {}, retrying {} more times".format(exitcode, retry)
         logging.info(msg)
-        run_cmds(commands, retry=retry - 1)
+        run_cmds(commands, retry=retry - 1, catchExcept=catchExcept)
     elif exitcode != 0 and catchExcept:
         msg = "Exit code was {}, but we will continue anyway"
         logging.info(msg.format(exitcode))
@@ -43,7 +210,7 @@ def run_cmds(commands, retry=0, catchExcept=False):
         assert exitcode == 0, "Exit code {}".format(exitcode)
 
 
-def get_file_from_url(url_path, temp_folder):
+def get_file_from_url(url_path, temp_folder, threads=16):
     """Get a file from a URL -- return the downloaded filepath."""
     logging.info("Getting file from {}".format(url_path))
 
@@ -60,21 +227,31 @@ def get_file_from_url(url_path, temp_folder):
         logging.info("Treating as local path")
         msg = "Input file does not exist ({})".format(url_path)
         assert os.path.exists(url_path), msg
-        logging.info("Making symbolic link in temporary folder")
-        os.symlink(url_path, local_path)
+        link_local_file(url_path, local_path)
 
     # Get files from AWS S3
     elif url_path.startswith('s3://'):
         logging.info("Getting reads from S3")
-        run_cmds([
-            'aws', 's3', 'cp', '--quiet', '--sse',
-            'AES256', url_path, temp_folder
-        ])
+        bucket, key = split_s3_url(url_path)
+        get_s3_client().download_file(
+            bucket, key, local_path, Config=s3_transfer_config(threads))
 
     # Get files from an FTP server
     elif url_path.startswith('ftp://'):
         logging.info("Getting reads from FTP")
-        run_cmds(['wget', '-P', temp_folder, url_path])
+        if shutil.which('aria2c') is not None:
+            # Split the download across several connections
+            run_cmds(['aria2c',
+                      '-x', '16',
+                      '-s', '16',
+                      '--file-allocation=none',
+                      '--console-log-level=warn',
+                      '--summary-interval=0',
+                      '-d', temp_folder,
+                      '-o', filename,
+                      url_path])
+        else:
+            run_cmds(['wget', '-P', temp_folder, url_path])
 
     else:
         raise Exception(
@@ -83,6 +260,293 @@ def get_file_from_url(url_path, temp_folder):
     return local_path
 
 
+def link_local_file(src, dst):
+    """Make `dst` a copy of `src` without copying any data, if possible."""
+    # Try a copy-on-write clone, which gives DIAMOND a file of its own
+    try:
+        with open(src, 'rb') as f_in, open(dst, 'wb') as f_out:
+            fcntl.ioctl(f_out.fileno(), FICLONE, f_in.fileno())
+        logging.info("Made a clone of the file in temporary folder")
+        return
+    except OSError:
+        if os.path.exists(dst):
+            os.unlink(dst)
+
+    # Otherwise use a hard link, if both are on the same filesystem
+    try:
+        os.link(src, dst)
+        logging.info("Made a hard link in temporary folder")
+        return
+    except OSError:
+        pass
+
+    # A relative link would be resolved from the temporary folder
+    logging.info("Making symbolic link in temporary folder")
+    os.symlink(os.path.abspath(src), dst)
+
+
+@contextlib.contextmanager
+def open_url(url_path, threads=16):
+    """Open a file on S3 or an FTP server, to be read as a stream of bytes (closed after the with block)."""
+    if url_path.startswith('s3://'):
+        bucket, key = split_s3_url(url_path)
+        size = get_s3_client().head_object(Bucket=bucket, Key=key)['ContentLength']
+        if size > S3_PARALLEL_SIZE:
+            f = io.BufferedReader(
+                ChunkReader(iter_s3_ranges(bucket, key, size, threads=threads)),
+                buffer_size=1 << 20)
+        else:
+            f = get_s3_client().get_object(Bucket=bucket, Key=key)['Body']
+    else:
+        f = urllib.request.urlopen(url_path)
+
+    # Decompress the file as it is read, if needed (GzipFile doesn't close
+    # the file it reads from, so that is closed separately)
+    with contextlib.closing(f):
+        if url_path.endswith('.gz'):
+            with gzip.GzipFile(fileobj=f, mode='rb') as f_gz:
+                yield f_gz
+        else:
+            yield f
+
+
+def get_reference_database(subject, db_prefix, temp_folder, threads=16, cache=None):
+    """Get the DIAMOND database for the subject, reusing a copy from the cache if there is one.
+
+    Returns the prefix of the database to align against.
+    """
+    if subject.endswith('.dmnd'):
+        # The subject is already a DIAMOND database
+        logging.info("Using prebuilt database: " + subject)
+        if "://" not in subject:
+            return os.path.abspath(subject)[:-5]
+        return get_file_from_url(subject, temp_folder, threads=threads)[:-5]
+
+    cache_key = None
+    if cache is not None:
+        cache_key = database_cache_key(subject)
+    if cache_key is None:
+        make_database(subject, db_prefix, temp_folder, threads=threads)
+        return db_prefix
+
+    cached_fp = "{}/{}.dmnd".format(cache.rstrip('/'), cache_key)
+    if cached_fp.startswith('s3://'):
+        bucket, key = split_s3_url(cached_fp)
+        try:
+            get_s3_client().head_object(Bucket=bucket, Key=key)
+            cached = True
+        except ClientError as e:
+            if e.response['Error']['Code'] != '404':
+                raise
+            cached = False
+        if cached:
+            logging.info("Downloading cached database: " + cached_fp)
+            get_s3_client().download_file(
+                bucket, key, db_prefix + '.dmnd', Config=s3_transfer_config(threads))
+            return db_prefix
+    elif os.path.exists(cached_fp):
+        # Use the cached database where it is
+        logging.info("Using cached database: " + cached_fp)
+        return cached_fp[:-5]
+
+    make_database(subject, db_prefix, temp_folder, threads=threads)
+
+    # Save the database to the cache
+    logging.info("Saving database to cache: " + cached_fp)
+    if cached_fp.startswith('s3://'):
+        get_s3_client().upload_file(
+            db_prefix + '.dmnd', bucket, key,
+            ExtraArgs=S3_UPLOAD_ARGS,
+            Config=s3_transfer_config(threads))
+    else:
+        # Copy to a temporary name, so that an incomplete file is never used
+        temp_fp = "{}.{}".format(cached_fp, uuid.uuid4())
+        shutil.copyfile(db_prefix + '.dmnd', temp_fp)
+        os.replace(temp_fp, cached_fp)
+    return db_prefix
+
+
+def database_cache_key(subject):
+    """Return a key for the contents of the subject, or None if it can't be found without downloading it."""
+    if subject.startswith('s3://'):
+        # The ETag changes whenever the object on S3 changes
+        bucket, key = split_s3_url(subject)
+        etag = get_s3_client().head_object(Bucket=bucket, Key=key)['ETag']
+        return hashlib.sha256("{}\n{}".format(subject, etag).encode()).hexdigest()
+
+    elif "://" not in subject:
+        # Hash the contents of a local file
+        h = hashlib.sha256()
+        with open(subject, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 22), b''):
+                h.update(chunk)
+        return h.hexdigest()
+
+    else:
+        logging.info("Databases are not cached for " + subject)
+        return None
+
+
+def make_database(subject, db_prefix, temp_folder, threads=16):
+    """Make a DIAMOND database from the subject, streaming a remote file straight into DIAMOND."""
+    if "://" not in subject:
+        subject_fp = get_file_from_url(subject, temp_folder, threads=threads)
+        run_cmds([
+            "diamond",
+            "makedb",
+            "--in", subject_fp,
+            "-d", db_prefix
+        ])
+        return
+
+    # Without --in, DIAMOND reads the sequences from STDIN
+    commands = ["diamond", "makedb", "-d", db_prefix]
+    logging.info("Streaming {} into DIAMOND".format(subject))
+    logging.info("Commands:")
+    logging.info(' '.join(commands))
+
+    # Keep the DIAMOND log in an unnamed temporary file, to log afterwards
+    with tempfile.TemporaryFile(dir=temp_folder) as diamond_log:
+        p = subprocess.Popen(commands,
+                             stdin=subprocess.PIPE,
+                             stdout=diamond_log,
+                             stderr=subprocess.STDOUT)
+        try:
+            with open_url(subject, threads=threads) as f:
+                shutil.copyfileobj(f, p.stdin, 1 << 22)
+        except BrokenPipeError:
+            # DIAMOND stopped early, which is reported by its exit code
+            pass
+        except:
+            p.kill()
+            raise
+        finally:
+            try:
+                p.stdin.close()
+            except BrokenPipeError:
+                pass
+        exitcode = p.wait()
+
+        logging.info("Output of DIAMOND:")
+        diamond_log.seek(0)
+        for line in diamond_log:
+            logging.info(line.decode("utf-8", "replace").rstrip("\n"))
+
+    assert exitcode == 0, "Exit code {}".format(exitcode)
+
+
+def available_memory_gb():
+    """Return the amount of memory which is available (in Gb)."""
+    # Use the estimate from the kernel, which counts reclaimable caches
+    if os.path.exists('/proc/meminfo'):
+        with open('/proc/meminfo', 'rt') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) / (1024. * 1024.)
+
+    return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE') / (1024. ** 3)
+
+
+def physical_cores():
+    """Return the number of physical cores which this process is allowed to run on."""
+    if hasattr(os, 'sched_getaffinity'):
+        cpus = os.sched_getaffinity(0)
+    else:
+        cpus = range(os.cpu_count())
+
+    # Hyperthreads on the same core list the same set of siblings
+    cores = set()
+    for cpu in cpus:
+        fp = "/sys/devices/system/cpu/cpu{}/topology/thread_siblings_list".format(cpu)
+        if os.path.exists(fp):
+            with open(fp, 'rt') as f:
+                cores.add(f.read().strip())
+        else:
+            cores.add(str(cpu))
+    return len(cores)
+
+
+def size_diamond_memory(blocks=None, index_chunks=None):
+    """Pick the DIAMOND block size and number of index chunks to fit the available memory."""
+    memory_gb = available_memory_gb()
+    logging.info("Memory available for alignment: {:.1f}Gb".format(memory_gb))
+
+    # DIAMOND uses roughly 6Gb for each block of the reference
+    if blocks is None:
+        blocks = int(min(max(memory_gb // 6, 1), 12))
+
+    # Processing the seed index in a single chunk is much faster, but uses
+    # more memory, so only do so when there is at least twice the memory needed
+    if index_chunks is None:
+        index_chunks = 1 if memory_gb >= 2 * 6 * blocks else 4
+
+    logging.info("Aligning with -b {} and -c {}".format(blocks, index_chunks))
+    return blocks, index_chunks
+
+
+def align_to_s3(commands, remote_path, temp_folder, threads=16, extra_args=None):
+    """Run DIAMOND, uploading the alignments to S3 as they are written out.
+
+    Any `extra_args` (e.g. ContentEncoding) are set on the uploaded object,
+    along with S3_UPLOAD_ARGS.
+    """
+    bucket, key = split_s3_url(remote_path)
+    logging.info("Commands:")
+    logging.info(' '.join(commands))
+    logging.info("Uploading the alignments to " + remote_path)
+
+    # Keep the DIAMOND log in an unnamed temporary file, to log afterwards
+    with tempfile.TemporaryFile(dir=temp_folder) as diamond_log:
+        # Without --out, DIAMOND writes the alignments to STDOUT, which are
+        # uploaded in parts as they arrive
+        p = subprocess.Popen(commands,
+                             stdout=subprocess.PIPE,
+                             stderr=diamond_log)
+        try:
+            get_s3_client().upload_fileobj(
+                p.stdout, bucket, key,
+                ExtraArgs=dict(S3_UPLOAD_ARGS, **(extra_args or {})),
+                Config=s3_transfer_config(threads))
+        except:
+            p.kill()
+            p.wait()
+            raise
+        exitcode = p.wait()
+
+        logging.info("Output of DIAMOND:")
+        diamond_log.seek(0)
+        for line in diamond_log:
+            logging.info(line.decode("utf-8", "replace").rstrip("\n"))
+
+    # Don't leave incomplete alignments on S3
+    if exitcode != 0:
+        get_s3_client().delete_object(Bucket=bucket, Key=key)
+    assert exitcode == 0, "Exit code {}".format(exitcode)
+
+
+def pick_diamond_tmpdir(db_fp, ramdisk="/dev/shm"):
+    """Return the ramdisk for DIAMOND's temporary files if it has room, otherwise None."""
+    if not os.path.isdir(ramdisk):
+        return None
+
+    # Leave room for temporary files of twice the size of the database
+    stat = os.statvfs(ramdisk)
+    free_bytes = stat.f_bavail * stat.f_frsize
+    if free_bytes < 2 * os.path.getsize(db_fp):
+        logging.info("Not enough space in {} for DIAMOND's temporary files".format(ramdisk))
+        return None
+
+    logging.info("Using {} for DIAMOND's temporary files".format(ramdisk))
+    return ramdisk
+
+
+def flush_logs():
+    """Wait until every log message so far has been written out."""
+    if LOG_LISTENER is not None:
+        LOG_LISTENER.stop()
+        LOG_LISTENER.start()
+
+
 def exit_and_clean_up(temp_folder):
     """Log the error messages and delete the temporary folder."""
     # Capture the traceback
@@ -98,6 +562,7 @@ def exit_and_clean_up(temp_folder):
     # Exit
     logging.info("Exit type: {}".format(exc_type))
     logging.info("Exit code: {}".format(exc_value))
+    flush_logs()
     sys.exit(exc_value)
 
 
@@ -115,7 +580,8 @@ if __name__ == "__main__":
                         type=str,
                         required=True,
                         help="""Location for 'subject' input file.
-                                (Supported: local path, s3://, or ftp://).""")
+                                (Supported: local path, s3://, or ftp://).
+                                A prebuilt DIAMOND database (.dmnd) is used as it is.""")
     parser.add_argument("--output-aln",
                         type=str,
                         required=True,
@@ -139,7 +605,18 @@ if __name__ == "__main__":
     parser.add_argument("--max-target-seqs",
                         type=int,
                         default=500,
-                        help="""Maximum number of alignments to report per query.""")
+                        help="""Maximum number of alignments to report per query.
+                        DIAMOND extends fewer hits for a smaller value (e.g. 25), which
+                        is much faster if only the top hits are used.""")
+    parser.add_argument("--sensitivity",
+                        type=str,
+                        choices=["fast", "mid-sensitive", "sensitive",
+                                 "more-sensitive", "very-sensitive",
+                                 "ultra-sensitive"],
+                        default=None,
+                        help="""DIAMOND sensitivity mode (default: DIAMOND's own default).
+                        The more sensitive modes find more distant hits, but run
+                        more slowly; fast is quickest, for close matches.""")
     parser.add_argument("--output-log",
                         type=str,
                         required=True,
@@ -156,10 +633,36 @@ if __name__ == "__main__":
                         type=int,
                         default=16,
                         help="Number of threads to use assembling.")
+    parser.add_argument("--gzip-upload",
+                        action="store_true",
+                        help="""Compress alignments uploaded to S3 even if --output-aln does not
+                                end in .gz, storing them with Content-Encoding: gzip.""")
+    parser.add_argument("--blocks",
+                        type=int,
+                        default=None,
+                        help="""Number of blocks used when aligning.
+                              Value relates to the amount of memory used.
+                              By default, this is set from the memory available.""")
+    parser.add_argument("--index-chunks",
+                        type=int,
+                        default=None,
+                        help="""Number of chunks used for the seed index when aligning.
+                              By default, 1 if there is plenty of memory, otherwise 4.""")
     parser.add_argument("--temp-folder",
                         type=str,
                         default='/share',
                         help="Folder used for temporary files.")
+    parser.add_argument("--diamond-tmpdir",
+                        type=str,
+                        default=None,
+                        help="""Folder used by DIAMOND for its own temporary files.
+                                By default, /dev/shm if it has room and --blocks and --index-chunks
+                                are both given, otherwise DIAMOND's default.""")
+    parser.add_argument("--dmnd-cache",
+                        type=str,
+                        default=None,
+                        help="""Folder (local path, or S3://) used to keep the DIAMOND database
+                                made from each subject, which is reused for the same subject.""")
 
     args = parser.parse_args()
 
@@ -170,17 +673,23 @@ if __name__ == "__main__":
     # Check that the temporary folder exists
     assert os.path.exists(args.temp_folder)
 
+    # Make sure the outputs can be written to S3, before doing any work
+    for output_url in [args.output_aln, args.output_log]:
+        if output_url.startswith("s3://"):
+            try:
+                check_s3_writable(output_url)
+            except (ClientError, BotoCoreError) as e:
+                sys.exit("Cannot write to {} ({})".format(output_url, e))
+
     # Set a random string, which will be appended to all temporary files
     random_string = str(uuid.uuid4())[:8]
 
     # Make a temporary folder within the --temp-folder with the random string
     temp_folder = os.path.join(args.temp_folder, str(random_string))
-    # Make sure it doesn't already exist
-    msg = "Collision, {} already exists".format(temp_folder)
-    assert os.path.exists(temp_folder) is False, msg
-    # Make the directory
+    # Make the directory (mkdir fails if the folder already exists, so a
+    # collision can't go unnoticed)
     os.mkdir(temp_folder)
-    
+
     # Make folders for the query, subject, and output
     temp_folders = {}
     for n in ["query", "subject", "output", "db"]:
@@ -197,100 +706,153 @@ if __name__ == "__main__":
     # Write to file
     fileHandler = logging.FileHandler(log_fp)
     fileHandler.setFormatter(logFormatter)
-    rootLogger.addHandler(fileHandler)
     # Also write to STDOUT
     consoleHandler = logging.StreamHandler()
     consoleHandler.setFormatter(logFormatter)
-    rootLogger.addHandler(consoleHandler)
-
-    # Get the subject and query files
-    try:
-        query_fp = get_file_from_url(args.query, temp_folders["query"])
-    except:
-        exit_and_clean_up(temp_folder)
-    try:
-        subject_fp = get_file_from_url(args.subject, temp_folders["subject"])
-    except:
-        exit_and_clean_up(temp_folder)
+    # Pass the messages through a queue, so that they are written out from
+    # a background thread instead of the one which is draining DIAMOND
+    log_queue = queue.Queue(-1)
+    rootLogger.addHandler(logging.handlers.QueueHandler(log_queue))
+    LOG_LISTENER = logging.handlers.QueueListener(
+        log_queue, fileHandler, consoleHandler)
+    LOG_LISTENER.start()
+
+    # Get the query in the background, while the reference database is
+    # made from the subject
+    db_prefix = os.path.join(temp_folders["db"], "db")
+    with ThreadPoolExecutor(max_workers=1) as pool:
+        query_download = pool.submit(get_file_from_url,
+                                     args.query,
+                                     temp_folders["query"],
+                                     threads=args.threads)
+
+        logging.info("Making reference database from " + args.subject)
+        try:
+            db_prefix = get_reference_database(args.subject,
+                                               db_prefix,
+                                               temp_folders["subject"],
+                                               threads=args.threads,
+                                               cache=args.dmnd_cache)
+        except:
+            # Wait for the query download to stop before deleting its files
+            query_download.exception()
+            exit_and_clean_up(temp_folder)
+        logging.info("Done making reference database")
+
+        try:
+            query_fp = query_download.result()
+        except:
+            exit_and_clean_up(temp_folder)
 
     logging.info("Query: " + query_fp)
-    logging.info("Subject: " + subject_fp)
 
-    # Make a reference database from the subject
-    logging.info("Making reference database")
-    db_prefix = os.path.join(temp_folders["db"], "db")
-    try:
-        run_cmds([
-            "diamond",
-            "makedb",
-            "--in", subject_fp,
-            "-d", db_prefix
-        ])
-    except:
-        exit_and_clean_up(temp_folder)
-    logging.info("Done making reference database")
+    # Don't run DIAMOND with more threads than there are cores, which slows it down
+    diamond_threads = min(args.threads, physical_cores())
+    if diamond_threads < args.threads:
+        logging.info("Aligning with {} threads, one per physical core, instead of {}".format(
+            diamond_threads, args.threads))
+
+    # Keep DIAMOND's temporary files on a ramdisk if there is room, but only
+    # if -b and -c were given (otherwise they are sized to use that memory)
+    diamond_tmpdir = args.diamond_tmpdir
+    if diamond_tmpdir is None and args.blocks is not None and args.index_chunks is not None:
+        diamond_tmpdir = pick_diamond_tmpdir(db_prefix + ".dmnd")
+
+    # Fit the DIAMOND settings to the memory available, unless they were given
+    blocks, index_chunks = size_diamond_memory(args.blocks, args.index_chunks)
 
     # Set up the arguments
-    output_fp = os.path.join(temp_folders["output"], "output.aln")
+    # (DIAMOND adds .gz to the name of the output file when compressing it)
+    output_prefix = os.path.join(temp_folders["output"], "output.aln")
+    output_fp = output_prefix
     arg_list = [
         "diamond",
         args.blast_type,
         "--db", db_prefix,
         "--query", query_fp,
-        "--out", output_fp,
         "--outfmt", args.outfmt,
         "--id", str(args.perc_identity),
         "--max-target-seqs", str(args.max_target_seqs),
         "--query-cover", str(args.query_cover),
         "--subject-cover", str(args.subject_cover),
-        "--threads", str(args.threads)
+        "--threads", str(diamond_threads),
+        "-b", str(blocks),
+        "-c", str(index_chunks)
     ]
+    if args.sensitivity is not None:
+        # Set the sensitivity mode, trading speed for distant hits
+        arg_list = arg_list + [
+            "--" + args.sensitivity
+        ]
+    if diamond_tmpdir is not None:
+        arg_list = arg_list + [
+            "--tmpdir", diamond_tmpdir
+        ]
     if args.blast_type == "blastx":
         # For BLASTX, specify the genetic code
         arg_list = arg_list + [
             "--query-gencode", str(args.query_gencode),
         ]
     # Gzip if specified
+    extra_args = None
     if args.output_aln.endswith(".gz"):
         arg_list = arg_list + [
             "--compress", "1"
         ]
         output_fp = output_fp + ".gz"
+        logging.info("Compressing the alignments with gzip")
+    elif args.gzip_upload and args.output_aln.startswith("s3://"):
+        # Upload fewer bytes, marking the object so that HTTP clients
+        # decompress it when it is downloaded
+        arg_list = arg_list + [
+            "--compress", "1"
+        ]
+        extra_args = {"ContentEncoding": "gzip"}
+        logging.info("Compressing the alignments with gzip for upload (Content-Encoding: gzip)")
+    else:
+        logging.info("Writing the alignments without compression")
+
+    if args.output_aln.startswith("s3://"):
+        # Upload the alignments while they are being made, rather than
+        # writing them to disk first
+        try:
+            align_to_s3(arg_list, args.output_aln, temp_folders["output"],
+                        threads=args.threads, extra_args=extra_args)
+        except:
+            exit_and_clean_up(temp_folder)
+        outputs = [(log_fp, args.output_log)]
 
-    # Run the command
-    try:
-        run_cmds(arg_list)
-    except:
-        exit_and_clean_up(temp_folder)
-
-    if not os.path.exists(output_fp):
-        logging.info(
-            "The output file ({}) does not exist, exiting".format(output_fp))
-        exit_and_clean_up(temp_folder)
-
-    # Return the results
-    for local_path, remote_path in [
-        (output_fp, args.output_aln),
-        (log_fp, args.output_log)
-    ]:
+    else:
+        # Run the command
+        try:
+            run_cmds(arg_list + ["--out", output_prefix])
+        except:
+            exit_and_clean_up(temp_folder)
+
+        if not os.path.exists(output_fp):
+            logging.info(
+                "The output file ({}) does not exist, exiting".format(output_fp))
+            exit_and_clean_up(temp_folder)
+        outputs = [(output_fp, args.output_aln), (log_fp, args.output_log)]
+
+    # Return the results, once the log file is complete
+    flush_logs()
+    for local_path, remote_path in outputs:
         if remote_path.startswith("s3://"):
             try:
-                run_cmds([
-                    "aws",
-                    "s3",
-                    "cp",
-                    local_path,
-                    remote_path
-                ])
+                # Upload the parts of large files in parallel
+                bucket, key = split_s3_url(remote_path)
+                logging.info("Uploading {} to {}".format(local_path, remote_path))
+                get_s3_client().upload_file(
+                    local_path, bucket, key,
+                    ExtraArgs=S3_UPLOAD_ARGS,
+                    Config=s3_transfer_config(args.threads))
             except:
                 exit_and_clean_up(temp_folder)
         else:
             try:
-                run_cmds([
-                    "mv",
-                    local_path,
-                    remote_path
-                ])
+                logging.info("Moving {} to {}".format(local_path, remote_path))
+                shutil.move(local_path, remote_path)
             except:
                 exit_and_clean_up(temp_folder)
 
@@ -300,4 +862,5 @@ if __name__ == "__main__":
 
     # Stop logging
     logging.info("Done")
+    LOG_LISTENER.stop()
     logging.shutdown()